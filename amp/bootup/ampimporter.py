@@ -12,15 +12,44 @@ Created on 2020/04
 """
 from __future__ import absolute_import, print_function
 
+import marshal
 import sys
 from . import blobstore
 try:
     import _frozen_importlib as frozen_importlib # noqa
 except ImportError:
     frozen_importlib = None
+try:
+    from _imp import _fix_co_filename # noqa
+except ImportError:
+    _fix_co_filename = None
+try:
+    FileNotFoundError = FileNotFoundError
+except NameError:
+    FileNotFoundError = IOError
+try:
+    from importlib.machinery import EXTENSION_SUFFIXES, ExtensionFileLoader, ModuleSpec
+    from importlib.util import module_from_spec, spec_from_file_location
+except ImportError:
+    import imp
+    EXTENSION_SUFFIXES = [suffix for suffix, _, kind in imp.get_suffixes() if kind == imp.C_EXTENSION]
+    ExtensionFileLoader = ModuleSpec = None
+try:
+    from importlib.util import LazyLoader
+except ImportError:
+    LazyLoader = None
+try:
+    from _frozen_importlib import _ModuleLockManager # noqa
+except ImportError:
+    _ModuleLockManager = None
+try:
+    import _imp as _imp_lock # noqa
+except ImportError:
+    import imp as _imp_lock
 
+PY2 = sys.version_info.major == 2
 ModuleType = type(sys)
-CodeType = type(compile("", "<string>"))
+CodeType = type(compile("", "<string>", "exec"))
 
 #region os.path operations, and utilities
 _builtin_names = sys.builtin_module_names
@@ -73,7 +102,7 @@ def norm_path(path, chars = ("\\", ), sep = "/"):
         if abs_begin and not is_abspath(npath):
             # special case: /path/to
             # /../../foo
-            return ""
+            return sep + npath
         else:
             return npath
     return g()
@@ -125,6 +154,27 @@ def os_path_dirname(path, **kw):
     else:
         return path[:ps]
 
+def match_prefixes(fullname, prefixes):
+    """
+    モジュールの完全名が、いずれかのパッケージ(またはモジュール)の完全名 `prefixes` 以下にあるかを得る;
+    "" はすべてのモジュールに一致する
+    """
+    for prefix in prefixes:
+        if not prefix or fullname == prefix or fullname.startswith(prefix + "."):
+            return True
+    return False
+
+def make_spec(fullname, loader, pypath):
+    """
+    :class:`PythonPath` から、 `loader` でロードされるモジュールの :class:`importlib.machinery.ModuleSpec` を生成する;
+    パッケージの `submodule_search_locations` は、パッケージのディレクトリとなる
+    """
+    spec = ModuleSpec(fullname, loader, origin = pypath, is_package = pypath.is_package)
+    spec.has_location = True
+    if pypath.is_package:
+        spec.submodule_search_locations.append(os_path_dirname(pypath))
+    return spec
+
 class MixinFunc(object):
     """
     Mixin-able object interface
@@ -172,6 +222,253 @@ class MixinFunc(object):
     
 #endregion os.path operations, and utilities
 
+#region import tracer
+#: environment variable which enables the import tracer;
+#: the trace is written to "$AMP_IMPORT_TRACE.json" (Chrome trace-event format) and "$AMP_IMPORT_TRACE.txt" at exit,
+#: or only the text report is written to stderr if the value is "-".
+TRACE_ENVIRON = "AMP_IMPORT_TRACE"
+#: stages of the import, in the order of the report columns
+TRACE_STAGES = ("find", "read", "unmarshal", "compile", "create", "exec")
+
+class TraceSpan(object):
+    """
+    (internal)
+    a span of the stage which is recorded by :class:`ImportTracer`
+    """
+    __slots__ = ("tracer", "stage", "fullname", "begin", "duration", "nested", "nbytes", "depth", "tid")
+    
+    def __init__(self, tracer, stage, fullname):
+        self.tracer = tracer
+        self.stage = stage
+        self.fullname = fullname
+        self.duration = self.nested = self.nbytes = 0
+    
+    def add_bytes(self, nbytes):
+        self.nbytes += nbytes
+    
+    def __enter__(self):
+        self.tracer._enter(self)
+        return self
+    
+    def __exit__(self, etype, einst, etrace):
+        self.tracer._exit(self)
+
+class NullSpan(object):
+    """
+    (internal)
+    the span which records nothing, while the tracer is disabled
+    """
+    def add_bytes(self, nbytes):
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, etype, einst, etrace):
+        pass
+
+NULL_SPAN = NullSpan()
+
+class ImportTracer(object):
+    """
+    AMPのインポータによるインポートの各段階(検索、読み込み、コンパイル、実行)の所要時間と読み込んだバイト数を記録するもの;
+    モジュールごとのインポートは "import" の区間として記録され、各区間の自身の所要時間は直下の区間を除いて求められる。
+    """
+    def __init__(self):
+        import threading
+        try:
+            from time import perf_counter as clock
+        except ImportError:
+            from time import time as clock
+        self.clock = clock
+        self.spans = []
+        self._local = threading.local()
+        self._get_ident = getattr(threading, "get_ident", None) or threading.current_thread
+    
+    def span(self, stage, fullname):
+        return TraceSpan(self, stage, fullname)
+    
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+    
+    def _enter(self, span):
+        stack = self._stack()
+        span.depth = len(stack)
+        span.tid = self._get_ident()
+        stack.append(span)
+        span.begin = self.clock()
+    
+    def _exit(self, span):
+        span.duration = self.clock() - span.begin
+        stack = self._stack()
+        stack.pop()
+        if stack:
+            # every span is excluded from the self time of its direct parent;
+            # e.g. the find of the submodule runs inside the exec of its parent, but is not a part of it
+            stack[-1].nested += span.duration
+        self.spans.append(span)
+    
+    def summary(self):
+        """
+        モジュールごとに集計した {fullname: {"import", "self", 各段階: 所要時間(秒), "bytes": 読み込んだバイト数}} を得る
+        """
+        modules = {}
+        for span in self.spans:
+            module = modules.get(span.fullname, None)
+            if module is None:
+                module = modules[span.fullname] = dict((key, 0) for key in ("import", "self", "bytes") + TRACE_STAGES)
+            # the self time of the module is the sum of the self times of the spans within its import, which excludes the nested imports;
+            # the find precedes the import, and is reported in its own column
+            if span.stage != "find":
+                module["self"] += span.duration - span.nested
+            if span.stage == "import":
+                module["import"] += span.duration
+            else:
+                module[span.stage] += span.duration - span.nested
+            module["bytes"] += span.nbytes
+        return modules
+    
+    def write_report(self, fp):
+        """
+        モジュールごとの所要時間(マイクロ秒)を、累積の所要時間の降順で書き出す (see also `python -X importtime`);
+        AMPのインポータが提供しなかったモジュールは、検索の所要時間の合計のみを書き出す
+        """
+        columns = ("import", "self") + TRACE_STAGES
+        fp.write("%s | %10s | module\n" % (" | ".join("%10s" % col for col in columns), "bytes"))
+        modules = self.summary()
+        missed = [name for name in modules if not modules[name]["import"] and not modules[name]["bytes"]]
+        for fullname in sorted(modules, key = lambda name: -modules[name]["import"]):
+            if fullname in missed:
+                continue
+            module = modules[fullname]
+            fp.write("%s | %10d | %s\n" % (
+                " | ".join("%10d" % (module[col] * 1000000) for col in columns),
+                module["bytes"],
+                fullname,
+            ))
+        if missed:
+            fp.write("(%d modules not found, find %d us)\n" % (len(missed), sum(modules[name]["find"] for name in missed) * 1000000))
+    
+    def write_chrome_trace(self, fp):
+        """
+        記録された区間を Chromeの trace-event形式(JSON)で書き出す; `chrome://tracing` や Perfettoで表示できる
+        """
+        import json
+        import os
+        base = min(span.begin for span in self.spans) if self.spans else 0
+        json.dump({
+            "traceEvents": [
+                {
+                    "name": "%s %s" % (span.stage, span.fullname),
+                    "cat": span.stage,
+                    "ph": "X",
+                    "ts": (span.begin - base) * 1000000,
+                    "dur": span.duration * 1000000,
+                    "pid": os.getpid(),
+                    "tid": span.tid if isinstance(span.tid, int) else id(span.tid),
+                    "args": {"module": span.fullname, "bytes": span.nbytes},
+                }
+                for span in sorted(self.spans, key = lambda span: span.begin)
+            ],
+            "displayTimeUnit": "ms",
+        }, fp)
+
+_tracer = None
+
+def start_tracing():
+    """
+    インポートの記録を開始し、記録先の :class:`ImportTracer` を得る
+    """
+    global _tracer
+    if _tracer is None:
+        _tracer = ImportTracer()
+    return _tracer
+
+def stop_tracing():
+    """
+    インポートの記録を終了し、記録された :class:`ImportTracer` を得る
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+def trace(stage, fullname):
+    """
+    インポートの段階の区間を記録するコンテキストマネージャを得る; 記録が無効な場合は何もしない
+    """
+    return _tracer.span(stage, fullname) if _tracer else NULL_SPAN
+
+def _trace_from_environ():
+    import os
+    output = os.environ.get(TRACE_ENVIRON, "")
+    if not output:
+        return
+    import atexit
+    tracer = start_tracing()
+    def write_trace():
+        stop_tracing()
+        if output == "-":
+            tracer.write_report(sys.stderr)
+            return
+        with open(output + ".json", "w") as fp:
+            tracer.write_chrome_trace(fp)
+        with open(output + ".txt", "w") as fp:
+            tracer.write_report(fp)
+    atexit.register(write_trace)
+#endregion import tracer
+
+#region import locks
+class GlobalImportLock(object):
+    """
+    (internal)
+    the interpreter's global (and re-entrant) import lock, as a context manager
+    """
+    def __enter__(self):
+        _imp_lock.acquire_lock()
+        return self
+    
+    def __exit__(self, etype, einst, etrace):
+        _imp_lock.release_lock()
+
+def module_lock(fullname):
+    """
+    対象のモジュールのインポートを排他するロック(コンテキストマネージャ)を得る;
+    インタプリタのインポート機構と同じモジュールごとのロックを使用するため、import文と並行しても同じモジュールを二重に実行しない。
+    モジュールごとのロックが無い環境(Python 2)では、インタプリタのグローバルなインポートロックを使用する
+    """
+    if _ModuleLockManager is not None:
+        return _ModuleLockManager(fullname)
+    return GlobalImportLock()
+
+_initializing = set() #: fullnames of the modules which are being executed by the AMP loaders
+
+def is_initializing(fullname, module):
+    """
+    対象のモジュールが(いずれかのスレッドで)実行中であるかを得る
+    """
+    return fullname in _initializing or getattr(getattr(module, "__spec__", None), "_initializing", False)
+
+def loaded_module(fullname):
+    """
+    sys.modules のモジュールを得る; 無い場合は None
+    
+    他のスレッドが実行中のモジュールは、その実行の完了を待ってから返却する;
+    スレッド間の循環インポートでは、importlib と同様に実行途中のモジュールを返却する
+    """
+    module = sys.modules.get(fullname, None)
+    if module is not None and is_initializing(fullname, module):
+        try:
+            with module_lock(fullname):
+                pass
+        except RuntimeError:
+            pass # importlib's _DeadlockError
+        module = sys.modules.get(fullname, None)
+    return module
+#endregion import locks
+
 #region abstract module finder/loaders
 class AbstractFinder(object):
     """
@@ -189,6 +486,13 @@ class AbstractFinder(object):
         caller, aborting the import.
         """
         return None
+    
+    def find_spec(self, fullname, path=None, target=None):
+        """
+        PEP-451 finder.find_spec() method for the ``sys.meta_path`` hook.
+        Return a ModuleSpec object if the module was found, or None if it wasn't.
+        """
+        return None
 
 class AbstractLoader(object):
     """
@@ -207,6 +511,20 @@ class AbstractLoader(object):
         into sys.modules using `fullname` as its name
         """
     
+    def create_module(self, spec):
+        """
+        PEP-451 loader.create_module() method;
+        Return None to create the module by the default semantics.
+        """
+        return None
+    
+    def exec_module(self, module):
+        """
+        PEP-451 loader.exec_module() method;
+        execute the module in its own namespace.
+        """
+        exec(self.get_code(module.__name__), module.__dict__)
+    
     #region optional PEP-302
     def get_filename(self, fullname):
         """
@@ -308,15 +626,22 @@ class RelativePathMixin(MixinFunc):
         basepath = self.get_basepath()
         if not is_basepath(path, basepath):
             return path
-        return path[len(basepath):]
+        return path[len(basepath):].lstrip("".join(os_seps))
     
     def define_module(self, pypath, sourcecode_or_codeobj):
         # TODO: document
         assert isinstance(pypath, PythonPath)
-        try:
-            return sys.modules[pypath.fullname]
-        except LookupError:
-            pass
+        module = loaded_module(pypath.fullname)
+        if module is not None:
+            return module
+        with module_lock(pypath.fullname):
+            # another thread may have loaded it while waiting; or the circular import in this thread
+            module = sys.modules.get(pypath.fullname, None)
+            if module is not None:
+                return module
+            return self.__define_module(pypath, sourcecode_or_codeobj)
+    
+    def __define_module(self, pypath, sourcecode_or_codeobj):
         module = ModuleType(pypath.fullname)
         module.__file__ = os_path_join(self.get_basepath(), pypath)
         if pypath.is_package:
@@ -325,20 +650,23 @@ class RelativePathMixin(MixinFunc):
         else:
             module.__package__ = pypath.package_path.fullname
         module.__loader__ = self
-        if frozen_importlib:
-            module.__spec__ = frozen_importlib.ModuleSpec(
-                pypath.fullname,
-                self,
-                is_package = pypath.is_package,
-            )
+        if ModuleSpec:
+            module.__spec__ = make_spec(pypath.fullname, self, pypath)
+            module.__spec__._initializing = True
+        _initializing.add(pypath.fullname)
         sys.modules[pypath.fullname] = module
         try:
-            exec(sourcecode_or_codeobj, module.__dict__)
-            module = sys.modules[pypath.fullname]
-            return module
+            with trace("exec", pypath.fullname):
+                exec(sourcecode_or_codeobj, module.__dict__)
+            # the module may have replaced itself in sys.modules
+            return sys.modules[pypath.fullname]
         except:
             sys.modules.pop(pypath.fullname, None)
             raise
+        finally:
+            _initializing.discard(pypath.fullname)
+            if ModuleSpec:
+                module.__spec__._initializing = False
 
 class PythonPath(str):
     """
@@ -359,6 +687,7 @@ class PythonPath(str):
         return str.__new__(cls, filepathlike)
     
     is_package = None
+    is_extension = False
     package_path = None
     
     def __init__(self, _, fullname):
@@ -371,13 +700,19 @@ class PythonModulePath(PythonPath):
     is_package = property(lambda self: False)
     
     def __init__(self, filepathlike, fullname):
-        PythonPath.__init__(self, _, fullname)
-        package_name = fullname.rsplit(".", 1)[0]
+        PythonPath.__init__(self, filepathlike, fullname)
+        package_name = fullname.rsplit(".", 1)[0] if "." in fullname else ""
         self.package_path = PythonPackagePath(
             os_path_join(os_path_dirname(filepathlike), "__init__.py"),
             package_name
         )
 
+class PythonExtensionPath(PythonModulePath):
+    """
+    Python extension module path string.
+    """
+    is_extension = property(lambda self: True)
+
 class PythonPackagePath(PythonPath):
     """
     Python package path string.
@@ -392,14 +727,24 @@ class AMPStackedFinder(AbstractFinder):
     モジュールの検索パスはただ一つのルートを持つように変更される
     """
     
-    def __init__(self, delegation_path):
+    def __init__(self, delegation_path, lazy = (), eager = ()):
         """
         初期化
         
         :param delegation_path: このファインダからロードされたモジュールの基底のパス
+        :param lazy: モジュール本体の実行を、最初の属性アクセスまで遅延するモジュール(およびそのサブモジュール)の完全名のリスト;
+            "" はすべてのモジュールを対象とする (see also :class:`importlib.util.LazyLoader`)
+        :param eager: `lazy` に含まれていても、インポート時に実行するモジュール(およびそのサブモジュール)の完全名のリスト;
+            インポート時の副作用(レジストリへの登録など)に依存するモジュールを与える
         """
         self.delegation_path = norm_path(delegation_path, sep = "/")
+        self.lazy = tuple(lazy)
+        self.eager = tuple(eager)
         self.__importers = []
+        self.__loaders = {} # importer: selectable_loader
+        self.__specs = {} # fullname: ModuleSpec, or None if no importer has it (negative cache)
+        self.__index = {} # fullname: (search order, importer)
+        self.__unindexed = [] # (search order, importer) of the importers which can't enumerate their modules
     
     def register(self, importer):
         """
@@ -410,7 +755,9 @@ class AMPStackedFinder(AbstractFinder):
         DelegationPathComposableMixin.check_is_like(importer)
         self.unregister(importer)
         self.__importers.append(importer)
+        self.__loaders[importer] = selectable_loader(self, importer)
         importer.set_delegate_path(self.delegation_path)
+        self.reindex()
         return importer
     
     def unregister(self, importer):
@@ -419,7 +766,9 @@ class AMPStackedFinder(AbstractFinder):
         """
         if importer in self.__importers:
             self.__importers.remove(importer)
+            del self.__loaders[importer]
             importer.clear_delegate_path()
+            self.reindex()
             return importer
     
     @property
@@ -430,12 +779,94 @@ class AMPStackedFinder(AbstractFinder):
         """
         return tuple(self.__importers)
     
+    def reindex(self):
+        """
+        登録されたモジュールローダが提供するモジュールの完全名から、それを最初に提供するモジュールローダへの索引を再構築する;
+        `fullnames` を持たない(モジュールを列挙できない)モジュールローダは、索引に代わって検索時に問い合わせられる
+        """
+        index, unindexed = {}, []
+        for order, importer in enumerate(self.__importers):
+            fullnames = getattr(importer, "fullnames", None)
+            if fullnames is None:
+                unindexed.append((order, importer))
+                continue
+            for fullname in fullnames():
+                if not fullname in index:
+                    index[fullname] = (order, importer)
+        self.__index = index
+        self.__unindexed = unindexed
+        self.invalidate_caches()
+    
+    def find_importer(self, fullname):
+        """
+        対象のモジュールを提供するモジュールローダを検索順序に従って得る; 見つからない場合は None
+        """
+        order, importer = self.__index.get(fullname, (len(self.__importers), None))
+        for unindexed_order, unindexed in self.__unindexed:
+            if unindexed_order >= order:
+                break
+            try:
+                unindexed.get_filename(fullname) # test
+                return unindexed
+            except ImportError:
+                pass
+        return importer
+    
     def find_module(self, fullname, path=None):
         # override
+        importer = self.find_importer(fullname)
+        if importer is not None:
+            return self.__loaders[importer]
+    
+    def find_spec(self, fullname, path=None, target=None):
+        # override
+        """
+        登録されたモジュールローダから対象のモジュールを検索し、 :class:`selectable_loader` でロードされる ModuleSpecを得る;
+        ModuleSpecはモジュールの完全名ごとにキャッシュされる;
+        見つからなかったことは、すべてのモジュールローダが索引を持つ場合にのみ記録される
+        (索引を持たないモジュールローダは、ディレクトリの更新を検出できるよう毎回問い合わせられる)
+        """
+        try:
+            spec = self.__specs[fullname]
+        except LookupError:
+            with trace("find", fullname):
+                importer = self.find_importer(fullname)
+                if importer is None:
+                    spec = None
+                else:
+                    loader = self.__loaders[importer]
+                    spec = make_spec(fullname, loader, loader.get_filename(fullname))
+            if spec is not None or not self.__unindexed:
+                self.__specs[fullname] = spec
+        if spec is not None and LazyLoader and not spec.origin.is_extension and self.is_lazy(fullname):
+            # LazyLoader rewrites the spec on exec_module; hand over a fresh one instead of the cached
+            return make_spec(fullname, LazyLoader(spec.loader), spec.origin)
+        return spec
+    
+    def is_lazy(self, fullname):
+        """
+        対象のモジュールの実行を遅延するかを得る;
+        拡張モジュールは常にインポート時に実行される
+        """
+        return match_prefixes(fullname, self.lazy) and not match_prefixes(fullname, self.eager)
+    
+    def fullnames(self):
+        """
+        登録されたモジュールローダが提供するモジュールの完全名を整列して得る;
+        モジュールを列挙できないモジュールローダのモジュールは含まれない
+        """
+        return sorted(self.__index)
+    
+    def invalidate_caches(self):
+        """
+        キャッシュされた ModuleSpec、および見つからなかったモジュールの記録を破棄する (see also :func:`importlib.invalidate_caches`);
+        登録されたモジュールローダのキャッシュも破棄される
+        """
+        self.__specs.clear()
         for importer in self.__importers:
-            found = importer.find_module(fullname, path = path)
-            if found:
-                return selectable_loader(self, found) # TODO: cache?
+            invalidate_caches = getattr(importer, "invalidate_caches", None)
+            if invalidate_caches:
+                invalidate_caches()
     
     def synth_path(self, loader_relpath):
         """
@@ -451,7 +882,7 @@ class AMPStackedFinder(AbstractFinder):
         対象の絶対パスを、このファインダの基底のパスからの相対パスとして分解した値を得る
         """
         assert is_basepath(synth_path, self.delegation_path)
-        return synth_path[len(self.delegation_path):]
+        return synth_path[len(self.delegation_path):].lstrip("".join(os_seps))
 
 class selectable_loader(AbstractLoader):
     """
@@ -470,9 +901,13 @@ class selectable_loader(AbstractLoader):
         対象の Python完全名を :func:`self.loader.load_module` でロードした後に、
         ファイルパスを :data:`self.parent` の相対パスとして再構成したモジュールを返却する
         """
-        try:
-            return sys.modules[fullname]
-        except LookupError:
+        mod = loaded_module(fullname)
+        if mod is not None:
+            return mod
+        with module_lock(fullname):
+            mod = sys.modules.get(fullname, None)
+            if mod is not None:
+                return mod
             mod = self.loader.load_module(fullname, entry_name = entry_name) # may be raise ImportError
             mod.__file__ = self.parent.synth_path(self.loader.get_relpath(mod.__file__))
             mod.__loader__ = self
@@ -491,6 +926,12 @@ class selectable_loader(AbstractLoader):
             sys.modules[fullname] = mod # override
             return mod
     
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+    
+    def exec_module(self, module):
+        self.loader.exec_module(module)
+    
     def get_filename(self, fullname):
         s = self.loader.get_filename(fullname)
         return s.__class__(self.parent.synth_path(s), fullname)
@@ -507,19 +948,99 @@ class selectable_loader(AbstractLoader):
     def get_data(self, path):
         path = os_path_join(self.loader.get_basepath(), self.parent.related_path(path))
         return self.loader.get_data(path)
+    
+    def get_resource_reader(self, fullname):
+        get_resource_reader = getattr(self.loader, "get_resource_reader", None)
+        return get_resource_reader(fullname) if get_resource_reader else None
 
 class AMPBlobStoreImporter(AbstractFinder, AbstractLoader, RelativePathMixin, DelegationPathComposableMixin):
     """
-    :class:`blobstore.BlobReader` で読み取れるコンテナファイルからモジュールを検索/ロードするインポータ
+    :class:`blobstore.BlobReader` で読み取れるコンテナファイルからモジュールを検索/ロードするインポータ;
+    コンテナ内の拡張モジュールは展開せずに、匿名ファイル(memfd)を経由してロードされる。
     """
-    def __init__(self, filename):
-        self.br = blobstore.BlobReader(filename)
+    def __init__(self, filename, extension_cache_dir = None, bytecode_cache_dir = None, prefetch_profile = None):
+        """
+        初期化
+        
+        :param filename: コンテナファイルのパス
+        :param extension_cache_dir: memfdが使用できない環境で、拡張モジュールをロードするために書き出すディレクトリ(省略時は一時ディレクトリ以下)
+        :param bytecode_cache_dir: コンテナ内にコンパイル済みのコードが無いモジュールの、コードオブジェクトをキャッシュするディレクトリ(省略時はキャッシュしない);
+            同じホストのプロセス間で共有でき、最初にインポートしたプロセスのみがコンパイルする
+        :param prefetch_profile: コンテナの要素の読み込み順序を記録するファイルのパス(省略時は記録しない);
+            ファイルが存在すればその要素を先読み(:func:`replay_prefetch`)し、存在しなければ読み込み順序を記録してプロセスの終了時に保存する
+        """
+        self.br = blobstore.open_blob(filename)
         self.__name_cache = {}
+        self.__spec_cache = {}
+        # {fullname: (entry name, is package)} recorded by the composer; None if the container has no table
+        self.__fullnames = None
+        if blobstore.FULLNAMES_ENTRY in self.br.files:
+            self.__fullnames = blobstore.parse_fullnames(self.br.read(blobstore.FULLNAMES_ENTRY))
         self._delegate_path = ""
+        self.extension_cache_dir = extension_cache_dir
+        self.bytecode_cache_dir = bytecode_cache_dir
+        self._extension_fds = {}
+        self._recorded = self._recording_pid = None
+        if prefetch_profile:
+            import os
+            if os.path.isfile(prefetch_profile):
+                self.replay_prefetch(prefetch_profile)
+            else:
+                import atexit
+                self.start_recording()
+                atexit.register(self.save_prefetch_profile, prefetch_profile)
     
     def get_basepath(self):
         return self.br.filename
     
+    def start_recording(self):
+        """
+        コンテナの要素の読み込み順序の記録を開始する
+        """
+        import os
+        recorded, seen = [], set()
+        def recorder(filename):
+            if not filename in seen:
+                seen.add(filename)
+                recorded.append(filename)
+        self._recorded = recorded
+        self._recording_pid = os.getpid()
+        self.br.recorder = recorder
+    
+    def save_prefetch_profile(self, profile):
+        """
+        記録を終了し、要素の読み込み順序を(1行に1つの要素名として)保存する;
+        このファイルは `amp compact --order` の要素の並び順としても使用できる。
+        記録を開始したプロセスのみが保存し、フォークされた子プロセスでは記録を破棄する
+        """
+        import os
+        self.br.recorder = None
+        recorded, self._recorded = self._recorded or [], None
+        if self._recording_pid != os.getpid():
+            return
+        self.write_cache_file(profile, "".join("%s\n" % name for name in recorded).encode("utf-8"))
+    
+    def replay_prefetch(self, profile):
+        """
+        保存された読み込み順序の要素を先読みし、先読みするバイト数を得る
+        """
+        with open(profile, "rb") as fp:
+            names = [name for name in fp.read().decode("utf-8").split("\n") if name]
+        return self.br.prefetch(names)
+    
+    def fullnames(self):
+        """
+        コンテナ内のすべてのモジュールの完全名を列挙する
+        """
+        if self.__fullnames is not None:
+            for fullname in self.__fullnames:
+                yield fullname
+            return
+        for name in self.br.files:
+            found = blobstore.module_fullname(name)
+            if found:
+                yield found[0]
+    
     def find_module(self, fullname, path=None):
         try:
             self.get_filename(fullname) # test
@@ -527,23 +1048,161 @@ class AMPBlobStoreImporter(AbstractFinder, AbstractLoader, RelativePathMixin, De
         except ImportError:
             pass
     
+    def find_spec(self, fullname, path=None, target=None):
+        try:
+            return self.__spec_cache[fullname]
+        except LookupError:
+            pass
+        try:
+            spec = self.__spec_cache[fullname] = make_spec(fullname, self, self.get_filename(fullname))
+            return spec
+        except ImportError:
+            pass
+    
     def load_module(self, fullname, entry_name=None):
-        pypath = self.get_rel_filename(fullname)
-        return self.define_module(pypath, self.get_code(fullname))
+        with trace("import", fullname):
+            pypath = self.get_rel_filename(fullname)
+            if pypath.is_extension:
+                with trace("create", fullname):
+                    return self.load_extension(pypath)
+            return self.define_module(pypath, self.get_code(fullname))
+    
+    def create_module(self, spec):
+        pypath = self.get_rel_filename(spec.name)
+        if not pypath.is_extension:
+            return None
+        with trace("create", spec.name):
+            path = self.materialize_extension(pypath)
+            loader = ExtensionFileLoader(spec.name, path)
+            module = loader.create_module(spec_from_file_location(spec.name, path, loader = loader))
+        module.__file__ = spec.origin
+        return module
+    
+    def exec_module(self, module):
+        # extension modules may rename themselves (e.g. `_decimal` is named "decimal"), so look up by the spec
+        fullname = module.__spec__.name
+        with trace("import", fullname):
+            pypath = self.get_rel_filename(fullname)
+            if pypath.is_extension:
+                with trace("exec", fullname):
+                    ExtensionFileLoader(fullname, self.materialize_extension(pypath)).exec_module(module)
+            else:
+                code = self.get_code(fullname)
+                with trace("exec", fullname):
+                    exec(code, module.__dict__)
     
     def get_rel_filename(self, fullname):
         if fullname in self.__name_cache:
             return self.__name_cache[fullname]
+        if self.__fullnames is not None and fullname in self.__fullnames:
+            return self.__table_filename(fullname)
+        # not in the table (the entries added by another writer); probe the conventional layout
         s = fullname.replace(".", "/")
         if (s + ".py") in self.br.files:
             result = PythonModulePath(s + ".py", fullname)
         elif (s + "/__init__.py") in self.br.files:
             result = PythonPackagePath(s + "/__init__.py", fullname)
         else:
-            raise ImportError(fullname)
+            for suffix in EXTENSION_SUFFIXES:
+                if (s + suffix) in self.br.files:
+                    result = PythonExtensionPath(s + suffix, fullname)
+                    break
+            else:
+                raise ImportError(fullname)
         self.__name_cache[fullname] = result
         return result
     
+    def __table_filename(self, fullname):
+        # resolves the fullname by the table of the composer, without probing the entries
+        filename, is_package = self.__fullnames[fullname]
+        if is_package:
+            result = PythonPackagePath(filename, fullname)
+        elif filename.endswith(".py"):
+            result = PythonModulePath(filename, fullname)
+        else:
+            result = PythonExtensionPath(filename, fullname)
+        self.__name_cache[fullname] = result
+        return result
+    
+    def load_extension(self, pypath):
+        """
+        コンテナ内の拡張モジュールをロードする;
+        Linuxでは `memfd_create` による匿名ファイルへ書き出して `/proc/self/fd/N` からロードし、
+        それ以外の環境では内容のハッシュ値で命名したキャッシュファイルからロードする。
+        """
+        module = loaded_module(pypath.fullname)
+        if module is not None:
+            return module
+        with module_lock(pypath.fullname):
+            module = sys.modules.get(pypath.fullname, None)
+            if module is not None:
+                return module
+            path = self.materialize_extension(pypath)
+            if ExtensionFileLoader is None:
+                module = imp.load_dynamic(pypath.fullname, path)
+            else:
+                loader = ExtensionFileLoader(pypath.fullname, path)
+                module = module_from_spec(spec_from_file_location(pypath.fullname, path, loader = loader))
+                sys.modules[pypath.fullname] = module
+                try:
+                    loader.exec_module(module)
+                except:
+                    sys.modules.pop(pypath.fullname, None)
+                    raise
+            module.__file__ = os_path_join(self.get_basepath(), pypath)
+            return module
+    
+    def materialize_extension(self, pypath):
+        """
+        拡張モジュールを dlopen可能なファイルとして書き出し、そのパスを得る
+        """
+        import os
+        if pypath.fullname in self._extension_fds:
+            return "/proc/self/fd/%d" % self._extension_fds[pypath.fullname]
+        data = self.br.read(pypath)
+        memfd_create = getattr(os, "memfd_create", None)
+        if memfd_create:
+            try:
+                fd = memfd_create(pypath.fullname, os.MFD_CLOEXEC)
+            except OSError:
+                pass
+            else:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                # keep it open; the fd number must not be reused by other extensions while this process lives
+                self._extension_fds[pypath.fullname] = fd
+                return "/proc/self/fd/%d" % fd
+        import hashlib
+        import tempfile
+        cache_dir = os.path.join(
+            self.extension_cache_dir or os.path.join(tempfile.gettempdir(), "amp-extensions"),
+            hashlib.sha256(data).hexdigest(),
+        )
+        path = os.path.join(cache_dir, pypath.rsplit("/", 1)[-1])
+        if os.path.isfile(path) and os.path.getsize(path) == len(data):
+            return path
+        self.write_cache_file(path, data)
+        return path
+    
+    def write_cache_file(self, path, data):
+        """
+        キャッシュファイルを書き出す;
+        一時ファイルへ書き込んでから置き換えるため、並行する他のプロセスが書き込み途中のファイルを読むことはない
+        """
+        import os
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+        tmppath = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmppath, "wb") as fp:
+            fp.write(data)
+        getattr(os, "replace", os.rename)(tmppath, path)
+    
     def get_filename(self, fullname):
         s = self.get_rel_filename(fullname)
         return s.__class__(os_path_join(self._delegate_path, s), fullname)
@@ -553,79 +1212,300 @@ class AMPBlobStoreImporter(AbstractFinder, AbstractLoader, RelativePathMixin, De
     
     def get_code(self, fullname):
         s = self.get_rel_filename(fullname)
-        return compile(self.br.read(s), s.__class__(os_path_join(self._delegate_path, s), fullname), "exec", dont_inherit=True)
+        if s.is_extension:
+            return None
+        filename = s.__class__(os_path_join(self._delegate_path, s), fullname)
+        code = self.get_precompiled_code(s, filename)
+        if code is not None:
+            return code
+        cache_path = self.get_bytecode_cache_path(s) if self.bytecode_cache_dir else None
+        if cache_path:
+            code = self.get_cached_code(cache_path, filename)
+            if code is not None:
+                return code
+        with trace("read", fullname) as span:
+            # compile() accepts the zero-copy view of the mapped blob on py3k
+            source = self.br.read(s) if PY2 else self.br.read_view(s)
+            span.add_bytes(len(source))
+        with trace("compile", fullname):
+            # co_filename must be the plain string to marshal the code
+            code = compile(source, str(filename), "exec", dont_inherit=True)
+        if cache_path:
+            try:
+                self.write_cache_file(cache_path, marshal.dumps(code))
+            except (IOError, OSError):
+                pass # the cache is optional; e.g. the read-only cache directory
+        return code
+    
+    def get_bytecode_cache_path(self, relpath):
+        """
+        `relpath` のコードオブジェクトのキャッシュファイルのパスを得る;
+        キャッシュはこのインタプリタの MAGIC_NUMBERと、格納された内容(チェックサムを持たない古いコンテナの場合はコンテナ自体の同一性と要素の位置)で識別される
+        """
+        import binascii
+        import hashlib
+        import os
+        entry = self.br.entry(relpath)
+        if entry.crc32 is not None:
+            key = "%s:%d:%d:%d:%d" % (relpath, entry.length, entry.raw_length, entry.codec, entry.crc32)
+        else:
+            st = os.stat(self.br.filename)
+            key = "%s:%s:%d:%r:%d:%d" % (relpath, os.path.abspath(self.br.filename), st.st_size, st.st_mtime, entry.offset, entry.length)
+        return os.path.join(
+            self.bytecode_cache_dir,
+            binascii.hexlify(blobstore.MAGIC_NUMBER).decode("ascii"),
+            hashlib.sha256(key.encode("utf-8")).hexdigest() + ".pyc",
+        )
+    
+    def get_cached_code(self, cache_path, filename):
+        """
+        キャッシュファイルからコードオブジェクトを得る; キャッシュが無い(または壊れている)場合は None
+        """
+        try:
+            with trace("read", filename.fullname) as span:
+                with open(cache_path, "rb") as fp:
+                    data = fp.read()
+                span.add_bytes(len(data))
+            with trace("unmarshal", filename.fullname):
+                code = marshal.loads(data)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(code, CodeType):
+            return None
+        if _fix_co_filename:
+            _fix_co_filename(code, filename)
+        return code
+    
+    def get_precompiled_code(self, relpath, filename):
+        """
+        returns the code object of `relpath` which is precompiled for this interpreter, or None
+        """
+        name = blobstore.code_entry_name(relpath)
+        if not name in self.br.files:
+            return None
+        with trace("read", filename.fullname) as span:
+            data = self.br.read(name) if PY2 else self.br.read_view(name)
+            span.add_bytes(len(data))
+        with trace("unmarshal", filename.fullname):
+            code = marshal.loads(data)
+        if _fix_co_filename:
+            # the code is compiled with the stored path; point its co_filename(s) to the one served by this importer
+            _fix_co_filename(code, filename)
+        return code
     
     def get_source(self, fullname):
-        return self.br.read(self.get_rel_filename(fullname))
+        s = self.get_rel_filename(fullname)
+        return None if s.is_extension else self.br.read(s)
     
     def get_data(self, path):
         return self.br.read(self.get_relpath(path))
+    
+    def get_resource_reader(self, fullname):
+        """
+        returns the :class:`BlobResourceReader` of the package `fullname`, or None if it's not a package
+        (see also :class:`importlib.abc.ResourceReader`)
+        """
+        s = self.get_rel_filename(fullname)
+        if not s.is_package:
+            return None
+        return BlobResourceReader(self.br, os_path_dirname(s))
+
+class BlobResourceReader(object):
+    """
+    :class:`importlib.abc.ResourceReader` of the package in :class:`blobstore.BlobReader`;
+    resources are opened as streams of the blob entries, so large resources are never loaded whole.
+    """
+    def __init__(self, br, package_dir):
+        self.br = br
+        self.package_dir = package_dir
+    
+    def _entry_name(self, resource):
+        return os_path_join(self.package_dir, resource)
+    
+    def open_resource(self, resource):
+        name = self._entry_name(resource)
+        if not name in self.br.files:
+            raise FileNotFoundError(name)
+        return self.br.open(name)
+    
+    def resource_path(self, resource):
+        # resources are not stored as the plain files
+        raise FileNotFoundError(self._entry_name(resource))
+    
+    def is_resource(self, name):
+        return self._entry_name(name) in self.br.files
+    
+    def contents(self):
+        try:
+            return self.br.listdir(self.package_dir)
+        except ValueError:
+            return []
+    
+    def files(self):
+        """
+        returns the :class:`BlobTraversable` of the package directory (see also :func:`importlib.resources.files`);
+        nested resources are reached by `/` and streamed by `open`
+        """
+        return BlobTraversable(self.br, self.package_dir)
 
-class AMPFilePthImporter(AbstractFinder, AbstractLoader, DelegationPathComposableMixin):
+class BlobTraversable(object):
+    """
+    :class:`importlib.resources.abc.Traversable` of an entry (or a directory) in :class:`blobstore.BlobReader`;
+    the protocol is implemented without the base class, so that importing this module doesn't load :mod:`importlib.resources`.
+    """
+    def __init__(self, br, path):
+        self.br = br
+        self.path = path
+    
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.path)
+    
+    @property
+    def name(self):
+        return self.path.rsplit("/", 1)[-1]
+    
+    def is_file(self):
+        return self.path in self.br.files
+    
+    def is_dir(self):
+        try:
+            self.br.listdir(self.path)
+            return True
+        except ValueError:
+            return False
+    
+    def iterdir(self):
+        try:
+            names = self.br.listdir(self.path)
+        except ValueError:
+            raise FileNotFoundError(self.path)
+        return iter([self.joinpath(name) for name in names])
+    
+    def joinpath(self, *descendants):
+        path = self.path
+        for descendant in descendants:
+            for name in str(descendant).split("/"):
+                if name:
+                    path = "%s/%s" % (path, name) if path else name
+        return self.__class__(self.br, path)
+    
+    __truediv__ = joinpath
+    __div__ = joinpath
+    
+    def open(self, mode = "r", *args, **kwargs):
+        if not mode in ("r", "rb"):
+            raise ValueError("Invalid mode %r; resources are read-only" % (mode, ))
+        if not self.is_file():
+            raise FileNotFoundError(self.path)
+        import io
+        stream = io.BufferedReader(self.br.open(self.path))
+        if mode == "rb":
+            return stream
+        return io.TextIOWrapper(stream, *args, **kwargs)
+    
+    def read_bytes(self):
+        if not self.is_file():
+            raise FileNotFoundError(self.path)
+        return self.br.read(self.path)
+    
+    def read_text(self, encoding = None):
+        with self.open("r", encoding = encoding) as fp:
+            return fp.read()
+
+class AMPFilePthImporter(AbstractFinder, AbstractLoader, RelativePathMixin, DelegationPathComposableMixin):
     """
     ファイルから読み取れるモジュールを検索/ロードするインポータ;
     通常のファイルパスインポータと異なり、 :class:`AMPStackedFinder` と連携できるようにパスを構成する。
+    
+    ディレクトリの一覧はディレクトリごとにキャッシュされ、その更新時刻が変わるまで再利用される(:class:`importlib.machinery.FileFinder` と同様);
+    モジュールの検索はディレクトリの stat のみで、接尾辞ごとにファイルの有無を問い合わせない。
     """
-    MODULE_FILE_SUFFIXES = [
-        ".py",
-        ".pyd",
-        ".pyc",
-    ]
+    MODULE_FILE_SUFFIXES = [".py"] + [suffix for suffix in EXTENSION_SUFFIXES if suffix != ".py"] + [".pyc"]
     
     def __init__(self, basepath):
         import os
         self.basepath = norm_path(basepath)
         self._os = os
-        self.__name_cache = {}
+        self.__listings = {} # relative directory path: (mtime, {name: is directory})
     
     def _join(self, *args):
         return self._os.path.join(self.basepath, *args)
     
-    def _isfile(self, *args):
-        return self._os.path.isfile(self._join(*args))
-    
-    def _isdir(self, *args):
-        return self._os.path.isdir(self._join(*args))
-    
     def get_basepath(self):
         return self.basepath
     
+    def listdir(self, reldir):
+        """
+        ディレクトリの {名前: ディレクトリであるか} を得る; ディレクトリが存在しない場合は None
+        """
+        path = self._join(reldir) if reldir else self.basepath
+        try:
+            mtime = self._os.stat(path).st_mtime
+        except OSError:
+            self.__listings.pop(reldir, None)
+            return None
+        cached = self.__listings.get(reldir, None)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        scandir = getattr(self._os, "scandir", None)
+        try:
+            if scandir:
+                it = scandir(path)
+                try:
+                    listing = dict((ent.name, ent.is_dir()) for ent in it)
+                finally:
+                    getattr(it, "close", lambda: None)()
+            else:
+                listing = dict((name, self._os.path.isdir(self._os.path.join(path, name))) for name in self._os.listdir(path))
+        except OSError:
+            return None
+        self.__listings[reldir] = (mtime, listing)
+        return listing
+    
+    def invalidate_caches(self):
+        """
+        キャッシュされたディレクトリの一覧を破棄する
+        """
+        self.__listings.clear()
+    
     def get_rel_filename(self, fullname):
         if not fullname:
             # no fullname
             raise ImportError(fullname)
-        if fullname in self.__name_cache:
-            return self.__name_cache[fullname]
-        names = s.rsplit(".", 1)
+        names = fullname.rsplit(".", 1)
         if len(names) == 1:
             # no package parts
-            ps = ""
-            ms = names
+            ps, ms = "", names[0]
         else:
             # package and module names
             ps, ms = names
         ps = ps.replace(".", "/")
-        # try package module
-        result = None
-        if self._isdir(ps, ms):
+        listing = self.listdir(ps)
+        if listing is None:
+            raise ImportError(fullname)
+        if listing.get(ms, False):
             # should be package
-            for suffix in self.MODULE_FILE_SUFFIXES:
+            package_dir = os_path_join(ps, ms)
+            package_listing = self.listdir(package_dir) or {}
+            for suffix in (".py", ".pyc"):
                 s = "__init__%s" % suffix
-                if self.isfile(ps, ms, s):
+                if package_listing.get(s, None) is False:
                     # found init py
-                    self.__name_cache[fullname] = result = PythonPackagePath(self._os.join(ps, ms, s), fullname)
+                    return PythonPackagePath(os_path_join(package_dir, s), fullname)
         # may be a file
-        if not result:
-            for suffinx in self.MODULE_FILE_SUFFIXES:
-                s = "%s%s" % (ms, suffix)
-                if self.isfile(ps, s):
-                    # found module
-                    result = PythonModulePath(self._os.join(ps, s), fullname)
-        if result:
-            self.__name_cache[fullname] = result
-            return result
-        else:
-            raise ImportError(fullname)
+        for suffix in self.MODULE_FILE_SUFFIXES:
+            s = "%s%s" % (ms, suffix)
+            if listing.get(s, None) is False:
+                # found module
+                path_class = PythonModulePath if suffix in (".py", ".pyc") else PythonExtensionPath
+                return path_class(os_path_join(ps, s), fullname)
+        raise ImportError(fullname)
+    
+    def find_spec(self, fullname, path=None, target=None):
+        try:
+            return make_spec(fullname, self, self.get_filename(fullname))
+        except ImportError:
+            pass
     
     def find_module(self, fullname, path=None):
         try:
@@ -635,8 +1515,38 @@ class AMPFilePthImporter(AbstractFinder, AbstractLoader, DelegationPathComposabl
             pass
     
     def load_module(self, fullname, entry_name=None, *args):
-        pypath = self.get_rel_filename(fullname)
-        return self.define_module(pypath, self.get_code(fullname))
+        with trace("import", fullname):
+            pypath = self.get_rel_filename(fullname)
+            if pypath.is_extension:
+                with trace("create", fullname):
+                    module = imp.load_dynamic(fullname, self._join(pypath)) if ExtensionFileLoader is None else \
+                        ExtensionFileLoader(fullname, self._join(pypath)).load_module(fullname)
+                module.__file__ = os_path_join(self.get_basepath(), pypath)
+                return module
+            return self.define_module(pypath, self.get_code(fullname))
+    
+    def create_module(self, spec):
+        pypath = self.get_rel_filename(spec.name)
+        if not pypath.is_extension:
+            return None
+        with trace("create", spec.name):
+            path = self._join(pypath)
+            loader = ExtensionFileLoader(spec.name, path)
+            module = loader.create_module(spec_from_file_location(spec.name, path, loader = loader))
+        module.__file__ = spec.origin
+        return module
+    
+    def exec_module(self, module):
+        fullname = module.__spec__.name
+        with trace("import", fullname):
+            pypath = self.get_rel_filename(fullname)
+            if pypath.is_extension:
+                with trace("exec", fullname):
+                    ExtensionFileLoader(fullname, self._join(pypath)).exec_module(module)
+            else:
+                code = self.get_code(fullname)
+                with trace("exec", fullname):
+                    exec(code, module.__dict__)
     
     #region optional PEP-302
     def get_filename(self, fullname):
@@ -648,49 +1558,97 @@ class AMPFilePthImporter(AbstractFinder, AbstractLoader, DelegationPathComposabl
     
     def get_code(self, fullname):
         s = self.get_rel_filename(fullname)
-        with open() #HERE
-        return compile(self.br.read(s), s.__class__(os_path_join(self._delegate_path, s), fullname), "exec", dont_inherit=True)
-    
-    def get_source(self, fullname):
-        return self.br.read(self.get_rel_filename(fullname))
-    
-    def get_data(self, path):
-        return self.br.read(self.get_relpath(path))
-    
-    def get_code(self, fullname):
-        """
-        Get the code object associated with the module.
-        ImportError should be raised if module not found.
-        """
-        raise ImportError(fullname)
+        if s.is_extension:
+            return None
+        filename = s.__class__(os_path_join(self._delegate_path, s), fullname)
+        with trace("read", fullname) as span:
+            with open(self._join(s), "rb") as fp:
+                data = fp.read()
+            span.add_bytes(len(data))
+        if s.endswith(".pyc"):
+            header_size = 16 if sys.version_info >= (3, 7) else 12 if sys.version_info >= (3, 3) else 8
+            if data[:4] != blobstore.MAGIC_NUMBER:
+                raise ImportError("Bad magic number in %s" % filename)
+            with trace("unmarshal", fullname):
+                code = marshal.loads(data[header_size:])
+            if _fix_co_filename:
+                _fix_co_filename(code, filename)
+            return code
+        with trace("compile", fullname):
+            return compile(data, str(filename), "exec", dont_inherit=True)
     
     def get_source(self, fullname):
-        """
-        Method should return the source code for the module as a string.
-        But frozen modules does not contain source code.
-        Return None.
-        """
-        return None
+        s = self.get_rel_filename(fullname)
+        if not s.endswith(".py"):
+            return None
+        with open(self._join(s), "rb") as fp:
+            return fp.read()
     
     def get_data(self, path):
-        """
-        This returns the data as a string, or raise IOError if the "file"
-        wasn't found. The data is always returned as if "binary" mode was used.
-        This method is useful getting resources with 'pkg_resources' that are
-        bundled with Python modules in the PYZ archive.
-        The 'path' argument is a path that can be constructed by munging
-        module.__file__ (or pkg.__path__ items)
-        """
-        """
-        An abstract method to return the bytes for the data located at path.
-        Loaders that have a file-like storage back-end that allows storing
-        arbitrary data can implement this abstract method to give direct access
-        to the data stored. OSError is to be raised if the path cannot be found.
-        The path is expected to be constructed using a module’s __file__
-        attribute or an item from a package’s __path__.
-        
-        Changed in version 3.4: Raises OSError instead of NotImplementedError.
-        """
-        raise IOError(path)
+        with open(self._join(self.get_relpath(path)), "rb") as fp:
+            return fp.read()
     #endregion optional PEP-302
 #endregion AMP importer implementations
+
+#region pre-fork warmup
+def warmup(prefixes = None, modules_file = None, finders = None):
+    """
+    プリフォーク型のサーバーなどで、フォークする前の親プロセスでモジュールをインポートしておく;
+    BLOBのマッピングとインポートされたモジュールは、フォークされた子プロセスへコピーオンライトで共有される。
+    
+    インポートの後に :func:`gc.freeze` (Python 3.7以降)で、それまでのオブジェクトを GCの対象から外し、
+    子プロセスの GCによる参照カウント以外の書き込みでページが複製されないようにする。
+    
+    :param prefixes: インポートするモジュール(およびそのサブモジュール)の完全名のリスト
+    :param modules_file: インポートするモジュールの完全名を1行に1つ記述したファイルのパス
+    :param finders: 対象の :class:`AMPStackedFinder` のリスト(省略時は sys.meta_path にあるもの)
+    :return: インポートしたモジュール数、読み込んだバイト数、インポートに失敗したモジュールなどの dict;
+        `prefixes` と `modules_file` を共に省略した場合は、ファインダが列挙できるすべてのモジュールをインポートする
+    """
+    import gc
+    import importlib
+    if finders is None:
+        finders = [finder for finder in sys.meta_path if isinstance(finder, AMPStackedFinder)]
+    names = []
+    if modules_file:
+        with open(modules_file, "rb") as fp:
+            names.extend(name.strip() for name in fp.read().decode("utf-8").splitlines() if name.strip())
+    if prefixes is not None or not modules_file:
+        prefixes = [""] if prefixes is None else list(prefixes)
+        for finder in finders:
+            names.extend(name for name in finder.fullnames() if match_prefixes(name, prefixes))
+    # the bytes read are counted by the tracer; borrow the running one, or trace only while warming up
+    own_tracer = _tracer is None
+    tracer = start_tracing()
+    first = len(tracer.spans)
+    imported, errors = 0, {}
+    try:
+        for name in sorted(set(names)):
+            if name in sys.modules:
+                continue
+            try:
+                module = importlib.import_module(name)
+                module.__dict__ # executes the lazy module
+                imported += 1
+            except KeyboardInterrupt:
+                raise
+            except BaseException as e:
+                # scripts may call sys.exit() or parse the arguments at import time
+                errors[name] = "%s: %s" % (e.__class__.__name__, e)
+    finally:
+        spans = tracer.spans[first:]
+        if own_tracer:
+            stop_tracing()
+    gc.collect()
+    freeze = getattr(gc, "freeze", None)
+    if freeze:
+        freeze()
+    return dict(
+        modules = imported,
+        bytes = sum(span.nbytes for span in spans if span.stage == "read"),
+        errors = errors,
+        frozen = gc.get_freeze_count() if freeze else None,
+    )
+#endregion pre-fork warmup
+
+_trace_from_environ()
@@ -7,6 +7,23 @@ Created on 2020/04/03
 '''
 from __future__ import unicode_literals, absolute_import, print_function
 
+import binascii
+import collections
+import io
+import marshal
+import mmap
+import os
+import struct
+import threading
+import zlib
+try:
+    from importlib.machinery import EXTENSION_SUFFIXES
+    from importlib.util import MAGIC_NUMBER
+except ImportError:
+    import imp
+    EXTENSION_SUFFIXES = [suffix for suffix, _, kind in imp.get_suffixes() if kind == imp.C_EXTENSION]
+    MAGIC_NUMBER = imp.get_magic()
+
 try:
     string_types = (str, unicode)
     text_type = unicode
@@ -34,6 +51,534 @@ LINEEND = "\n"
 LINEEND2 = LINEEND * 2
 bLINEEND, bLINEEND2 = ensure_bytes(LINEEND), ensure_bytes(LINEEND2)
 
+#: blob format versions;
+#: version 0 is the legacy format which has the text journal as a header of the data body,
+#: and version 1 (or later) has the index as a trailer which is pointed by the fixed-size footer.
+#: version 2 (or later) has the binary index instead of the text journal.
+#: version 3 (or later) records the raw length and the compression codec of each entry.
+#: version 4 (or later) records the CRC32 of the stored bytes of each entry.
+#: version 5 (or later) has the directory table in the index.
+#: blobs of version 1 (or later) begin with :data:`HEADER_MAGIC` since version 5; older ones begin with the data body.
+FORMAT_HEADER_JOURNAL = 0
+FORMAT_TRAILER_JOURNAL = 1
+FORMAT_BINARY_INDEX = 2
+FORMAT_CODECS = 3
+FORMAT_CHECKSUMS = 4
+FORMAT_DIRECTORIES = 5
+FORMAT_VERSION = FORMAT_DIRECTORIES
+
+FOOTER_MAGIC = b"AMPBLOB\0"
+#: leading magic of the trailer-indexed blob; tells it from the legacy header-journal blob even if its footer is missing
+HEADER_MAGIC = b"AMPBLOB\1"
+#: footer; (magic, format version, index offset, index length)
+FOOTER = struct.Struct(str("<8sIQQ"))
+#: binary index header; (entry count, record size, names table offset from the beginning of the index)
+INDEX_HEADER = struct.Struct(str("<IIQ"))
+#: binary index records of each format version;
+#: (name offset in the names table, name length, data offset, stored length[, raw length, codec[, crc32]])
+INDEX_RECORDS = {
+    FORMAT_BINARY_INDEX: struct.Struct(str("<IIQQ")),
+    FORMAT_CODECS: struct.Struct(str("<IIQQQI")),
+    FORMAT_CHECKSUMS: struct.Struct(str("<IIQQQII")),
+    FORMAT_DIRECTORIES: struct.Struct(str("<IIQQQII")),
+}
+INDEX_RECORD = INDEX_RECORDS[FORMAT_VERSION]
+#: directory table header, which follows the names table; (directory count, children table offset from the beginning of the index)
+DIRECTORY_HEADER = struct.Struct(str("<IQ"))
+#: directory records, sorted by the name; the root directory has the empty name.
+#: the name refers to the names table (as the prefix of a name of its descendants).
+#: (name offset in the names table, name length, first child, child count)
+DIRECTORY_RECORD = struct.Struct(str("<IIII"))
+#: children table; each child is the index of the file record, or the index of the directory record with `CHILD_DIRECTORY` bit.
+#: children of each directory are sorted by the base name.
+DIRECTORY_CHILD = struct.Struct(str("<I"))
+CHILD_DIRECTORY = 0x80000000
+
+#: index entry; `length` is the stored length of the extent at `offset`, and `raw_length` is the one after decompression.
+#: `crc32` is the CRC32 of the stored bytes, or None if the blob has no checksums.
+Entry = collections.namedtuple("Entry", "offset length raw_length codec crc32")
+
+class CorruptedEntryError(ValueError):
+    """
+    the stored bytes of the entry don't match its checksum
+    """
+
+def crc32(data, value = 0):
+    return zlib.crc32(data, value) & 0xffffffff
+
+class Codec(object):
+    """
+    per-entry compression codec
+    """
+    def __init__(self, codec_id, name, compress, decompress, compressobj, decompressobj):
+        self.codec_id = codec_id
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+        self.compressobj = compressobj
+        self.decompressobj = decompressobj
+
+CODEC_STORED = 0
+CODEC_ZLIB = 1
+CODEC_BZ2 = 2
+CODEC_LZMA = 3
+#: available codecs, by the codec id and the name;
+#: the codecs of the optional modules are registered by :func:`get_codec` on their first use
+CODECS = {}
+def _register_codec(codec):
+    CODECS[codec.codec_id] = CODECS[codec.name] = codec
+    return codec
+_register_codec(Codec(CODEC_ZLIB, "zlib", zlib.compress, zlib.decompress, zlib.compressobj, zlib.decompressobj))
+
+def _bz2_codec():
+    import bz2
+    return Codec(CODEC_BZ2, "bz2", bz2.compress, bz2.decompress, bz2.BZ2Compressor, bz2.BZ2Decompressor)
+
+def _lzma_codec():
+    import lzma
+    return Codec(CODEC_LZMA, "lzma", lzma.compress, lzma.decompress, lzma.LZMACompressor, lzma.LZMADecompressor)
+
+#: factories of the codecs whose modules are imported lazily; most processes only read zlib or stored entries
+_CODEC_FACTORIES = {
+    CODEC_BZ2: _bz2_codec,
+    "bz2": _bz2_codec,
+    CODEC_LZMA: _lzma_codec,
+    "lzma": _lzma_codec,
+}
+
+def get_codec(codec):
+    """
+    returns the :class:`Codec` of the codec id or name, or None for `stored` (no compression)
+    """
+    if codec in (None, CODEC_STORED, "stored"):
+        return None
+    try:
+        return CODECS[codec]
+    except LookupError:
+        pass
+    factory = _CODEC_FACTORIES.get(codec, None)
+    if factory is not None:
+        try:
+            return _register_codec(factory())
+        except ImportError:
+            pass
+    raise ValueError("Unknown or unavailable codec %r" % (codec, ))
+
+def format_journal(files):
+    """
+    (internal)
+    make the text journal from (filename, offset, length) tuples
+    """
+    return ensure_bytes(
+        LINEEND.join(
+            ("%s%s%s%s%s" % (fn, LINEEND, fp, LINEEND, fz) for fn, fp, fz in files)
+        )
+    )
+
+def parse_journal(journal, offset = 0):
+    """
+    (internal)
+    parse the text journal into a dict of {filename: (offset + `offset`, length)}
+    """
+    if not journal:
+        return {}
+    lines = ensure_text(journal).split(LINEEND)
+    return dict(
+        zip(
+            lines[::3],
+            zip(
+                map((lambda s: int(s) + offset), lines[1::3]),
+                map((lambda s: int(s)), lines[2::3])
+            )
+        )
+    )
+
+def format_index(files):
+    """
+    (internal)
+    make the binary index from (filename, offset, stored length, raw length, codec) tuples;
+    records are sorted by the encoded filename, and the last one wins if a filename is duplicated
+    """
+    entries = sorted(dict((ensure_bytes(ent[0]), ent[1:]) for ent in files).items())
+    records, names = [], []
+    name_offset = 0
+    # directory name: [name offset, [(base name, child)]]
+    directories = {b"": [0, []]}
+    for i, (name, fields) in enumerate(entries):
+        records.append(INDEX_RECORD.pack(name_offset, len(name), *fields))
+        names.append(name)
+        child, path = i, name
+        while True:
+            p = path.rfind(b"/")
+            parent = path[:max(p, 0)]
+            known = parent in directories
+            if not known:
+                directories[parent] = [name_offset, []]
+            directories[parent][1].append((path[p + 1:], child))
+            if known:
+                break
+            child, path = parent, parent
+        name_offset += len(name)
+    dirnames = sorted(directories)
+    dirindices = dict((dirname, i) for i, dirname in enumerate(dirnames))
+    dirrecords, children = [], []
+    for dirname in dirnames:
+        dir_name_offset, members = directories[dirname]
+        dirrecords.append(DIRECTORY_RECORD.pack(dir_name_offset, len(dirname), len(children), len(members)))
+        for _, child in sorted(members, key = lambda member: member[0]):
+            children.append(DIRECTORY_CHILD.pack(child if isinstance(child, int) else dirindices[child] | CHILD_DIRECTORY))
+    names_offset = INDEX_HEADER.size + INDEX_RECORD.size * len(records)
+    directory_offset = names_offset + name_offset
+    children_offset = directory_offset + DIRECTORY_HEADER.size + DIRECTORY_RECORD.size * len(dirrecords)
+    header = INDEX_HEADER.pack(len(records), INDEX_RECORD.size, names_offset)
+    dirheader = DIRECTORY_HEADER.pack(len(dirrecords), children_offset)
+    return b"".join([header] + records + names + [dirheader] + dirrecords + children)
+
+def split_dirname(dirname):
+    """
+    (internal)
+    normalizes the directory name to the one in the index; the root directory is the empty name
+    """
+    return ensure_text(dirname).strip("/")
+
+class BinaryIndex(object):
+    """
+    (internal)
+    read-only mapping of {filename: (offset, stored length)} on the binary index;
+    records are binary-searched directly in `buf` (e.g. :class:`mmap.mmap`), so nothing is parsed upfront.
+    """
+    def __init__(self, buf, offset = 0, version = FORMAT_VERSION):
+        self.buf = buf
+        self.record_struct = INDEX_RECORDS[version]
+        self.count, self.record_size, names_offset = INDEX_HEADER.unpack_from(buf, offset)
+        self.records_base = offset + INDEX_HEADER.size
+        self.names_base = offset + names_offset
+        self.has_directories = version >= FORMAT_DIRECTORIES
+        if self.has_directories:
+            # the directory table follows the names table, which ends at the name of the last record
+            last = self.record(self.count - 1) if self.count else (0, 0)
+            directory_offset = self.names_base + last[0] + last[1]
+            self.directory_count, children_offset = DIRECTORY_HEADER.unpack_from(buf, directory_offset)
+            self.directories_base = directory_offset + DIRECTORY_HEADER.size
+            self.children_base = offset + children_offset
+    
+    def record(self, i):
+        return self.record_struct.unpack_from(self.buf, self.records_base + i * self.record_size)
+    
+    def name(self, record):
+        begin = self.names_base + record[0]
+        return self.buf[begin:begin + record[1]]
+    
+    def find(self, filename):
+        """
+        returns the record of `filename`, or None
+        """
+        key = ensure_bytes(filename)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = self.record(mid)
+            name = self.name(record)
+            if name < key:
+                lo = mid + 1
+            elif key < name:
+                hi = mid
+            else:
+                return record
+        return None
+    
+    def entry(self, filename):
+        """
+        returns the :class:`Entry` of `filename`, or None
+        """
+        record = self.find(filename)
+        if record is None:
+            return None
+        return self.record_entry(record)
+    
+    def record_entry(self, record):
+        if len(record) > 6:
+            return Entry(*record[2:7])
+        elif len(record) > 4:
+            return Entry(record[2], record[3], record[4], record[5], None)
+        else:
+            return Entry(record[2], record[3], record[3], CODEC_STORED, None)
+    
+    def get(self, filename, default = None):
+        record = self.find(filename)
+        return default if record is None else record[2:4]
+    
+    def __getitem__(self, filename):
+        record = self.find(filename)
+        if record is None:
+            raise KeyError(filename)
+        return record[2:4]
+    
+    def __contains__(self, filename):
+        return self.find(filename) is not None
+    
+    def __len__(self):
+        return self.count
+    
+    def __iter__(self):
+        for i in range(self.count):
+            yield ensure_text(self.name(self.record(i)))
+    
+    keys = __iter__
+    
+    def items(self):
+        for i in range(self.count):
+            record = self.record(i)
+            yield ensure_text(self.name(record)), record[2:4]
+    
+    def entries(self):
+        for i in range(self.count):
+            record = self.record(i)
+            yield ensure_text(self.name(record)), self.record_entry(record)
+    
+    def directory(self, i):
+        return DIRECTORY_RECORD.unpack_from(self.buf, self.directories_base + i * DIRECTORY_RECORD.size)
+    
+    def find_directory(self, dirname):
+        """
+        returns the directory record of `dirname`, or None
+        """
+        key = ensure_bytes(split_dirname(dirname))
+        lo, hi = 0, self.directory_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = self.directory(mid)
+            name = self.name(record)
+            if name < key:
+                lo = mid + 1
+            elif key < name:
+                hi = mid
+            else:
+                return record
+        return None
+    
+    def listdir(self, dirname):
+        """
+        returns (directory names, file names) of the children of `dirname`, or None if no such directory;
+        each name is the base name, and they are sorted
+        """
+        record = self.find_directory(dirname)
+        if record is None:
+            return None
+        dirnames, filenames = [], []
+        first, count = record[2], record[3]
+        for i in range(first, first + count):
+            child, = DIRECTORY_CHILD.unpack_from(self.buf, self.children_base + i * DIRECTORY_CHILD.size)
+            if child & CHILD_DIRECTORY:
+                name = self.name(self.directory(child & ~CHILD_DIRECTORY))
+                dirnames.append(ensure_text(name[name.rfind(b"/") + 1:]))
+            else:
+                name = self.name(self.record(child))
+                filenames.append(ensure_text(name[name.rfind(b"/") + 1:]))
+        return dirnames, filenames
+
+class DirectoryTree(object):
+    """
+    (internal)
+    directory tree of the blob which has no directory table;
+    it's built from all the names at once, on the first listing.
+    """
+    def __init__(self, filenames):
+        self.directories = {"": (set(), [])}
+        for filename in filenames:
+            path = ensure_text(filename)
+            child, is_dir = path, False
+            while True:
+                p = child.rfind("/")
+                parent = child[:max(p, 0)]
+                known = parent in self.directories
+                if not known:
+                    self.directories[parent] = (set(), [])
+                if is_dir:
+                    self.directories[parent][0].add(child[p + 1:])
+                else:
+                    self.directories[parent][1].append(child[p + 1:])
+                if known:
+                    break
+                child, is_dir = parent, True
+    
+    def listdir(self, dirname):
+        found = self.directories.get(split_dirname(dirname), None)
+        if found is None:
+            return None
+        return sorted(found[0]), sorted(found[1])
+
+#: prefix of the entries which are reserved by the blob itself
+AMP_PREFIX = "__amp__/"
+#: prefix of the entries of marshalled code objects
+CODE_PREFIX = AMP_PREFIX + "code/"
+#: entry of the top-level index of the sharded blob, which lists the suffixes of the shard files
+SHARDS_ENTRY = AMP_PREFIX + "shards"
+#: entry of the table of Python modules; see also :func:`format_fullnames`
+FULLNAMES_ENTRY = AMP_PREFIX + "fullnames"
+#: the largest gap between the extents which are coalesced into a single read-ahead; see also :func:`BlobReader.prefetch`
+PREFETCH_GAP = 64 * 1024
+
+def code_entry_name(filename, magic = MAGIC_NUMBER):
+    """
+    returns the entry name of the marshalled code object of `filename`,
+    which is built for the interpreter of `magic` (see also :data:`importlib.util.MAGIC_NUMBER`)
+    """
+    return "%s%s/%s" % (CODE_PREFIX, ensure_text(binascii.hexlify(magic)), filename)
+
+def format_fullnames(table):
+    """
+    makes the table of Python modules from (fullname, entry name, is package) tuples;
+    each line of the table is the tab-separated fullname, entry name, and "1" for packages (or "0")
+    """
+    return ensure_bytes(LINEEND.join(
+        "%s\t%s\t%d" % (ensure_text(fullname), ensure_text(filename), 1 if is_package else 0)
+        for fullname, filename, is_package in table
+    ))
+
+def parse_fullnames(data):
+    """
+    parses the table of Python modules into {fullname: (entry name, is package)}
+    """
+    table = {}
+    for line in ensure_text(data).split(LINEEND):
+        if line:
+            fullname, filename, is_package = line.split("\t")
+            table[fullname] = (filename, is_package == "1")
+    return table
+
+def module_fullname(filename):
+    """
+    returns (fullname, is package) of the Python module which is stored as the entry `filename` in the conventional layout
+    (a source, a package's __init__.py, or an extension module of this interpreter), or None for the other entries
+    """
+    if filename.startswith(AMP_PREFIX):
+        return None
+    if filename.endswith("/__init__.py"):
+        return filename[:-len("/__init__.py")].replace("/", "."), True
+    if filename.endswith(".py"):
+        return filename[:-len(".py")].replace("/", "."), False
+    for suffix in EXTENSION_SUFFIXES:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)].replace("/", "."), False
+    return None
+
+class EntryIO(io.RawIOBase):
+    """
+    read-only, seekable file-like object which is bounded to the extent of an entry;
+    see also :func:`BlobReader.open`
+    
+    with `entry`, the checksum is verified when the extent is read through sequentially from its beginning.
+    """
+    def __init__(self, reader, offset, length, entry = None):
+        io.RawIOBase.__init__(self)
+        self._reader = reader
+        self._offset = offset
+        self._length = length
+        self._pos = 0
+        self._entry = entry
+        self._crc = self._crc_pos = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self._pos
+    
+    def seek(self, pos, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self._length
+        elif whence != os.SEEK_SET:
+            raise ValueError("Invalid whence %r" % (whence, ))
+        if pos < 0:
+            raise ValueError("Negative seek position %d" % pos)
+        self._pos = pos
+        return pos
+    
+    def readinto(self, b):
+        n = min(len(b), self._length - self._pos)
+        if n <= 0:
+            return 0
+        data = self._reader._read_range(self._offset + self._pos, n)
+        memoryview(b)[:n] = data
+        if self._entry is not None and self._crc_pos == self._pos:
+            self._crc = crc32(data, self._crc)
+            self._crc_pos += n
+            if self._crc_pos == self._length:
+                self._reader._check(self._entry, self._crc)
+        self._pos += n
+        return n
+
+class DecompressingEntryIO(io.RawIOBase):
+    """
+    read-only, seekable file-like object which decompresses a compressed entry while reading;
+    seeking backward restarts the decompression from the beginning of the entry.
+    """
+    CHUNK_SIZE = 1024 * 16
+    
+    def __init__(self, stored, codec, length):
+        io.RawIOBase.__init__(self)
+        self._stored = stored
+        self._codec = codec
+        self._length = length
+        self._rewind()
+    
+    def _rewind(self):
+        self._stored.seek(0)
+        self._decompressor = self._codec.decompressobj()
+        self._buf = b""
+        self._buf_pos = 0
+        self._pos = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self._pos
+    
+    def seek(self, pos, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self._length
+        elif whence != os.SEEK_SET:
+            raise ValueError("Invalid whence %r" % (whence, ))
+        if pos < 0:
+            raise ValueError("Negative seek position %d" % pos)
+        if pos < self._pos:
+            self._rewind()
+        scratch = bytearray(self.CHUNK_SIZE)
+        while self._pos < pos and self.readinto(memoryview(scratch)[:min(len(scratch), pos - self._pos)]):
+            pass
+        self._pos = pos
+        return pos
+    
+    def readinto(self, b):
+        view = memoryview(b)
+        filled = 0
+        while filled < len(view):
+            if self._buf_pos >= len(self._buf):
+                stored = self._stored.read(self.CHUNK_SIZE)
+                if not stored:
+                    break
+                self._buf = self._decompressor.decompress(stored)
+                self._buf_pos = 0
+                continue
+            n = min(len(view) - filled, len(self._buf) - self._buf_pos)
+            view[filled:filled + n] = memoryview(self._buf)[self._buf_pos:self._buf_pos + n]
+            self._buf_pos += n
+            filled += n
+        self._pos += filled
+        return filled
+
 class Storage(object):
     OPEN_MODE = None
     BUFFERING = 1024 * 1024 * 5
@@ -52,10 +597,10 @@ class Storage(object):
                 break
             yield buf
     
-    def __init__(self, stored):
+    def __init__(self, stored, mode = None):
         self.filename = stored
         self.files = []
-        self.fp = self.sopen(stored, self.OPEN_MODE)
+        self.fp = self.sopen(stored, mode or self.OPEN_MODE)
     
     def __enter__(self):
         return self
@@ -70,12 +615,159 @@ class Storage(object):
         self.fp = None
     
 class BlobWriter(Storage):
+    """
+    writer of the blob file;
+    entries of at least `min_size` bytes are compressed with `codec` (a name or an id of :data:`CODECS`),
+    and are stored as is when the compression doesn't shrink them.
+    
+    with `dedup` (default), payloads are content-addressed by their SHA-256 digest;
+    an entry whose payload was already written points to the stored extent instead of writing it again.
+    :data:`dedup_count` and :data:`dedup_saved` report how many entries and stored bytes were saved.
+    
+    with `append`, an existing blob is updated incrementally instead of being rewritten;
+    new or changed entries are written at the end, followed by the new index which supersedes the old one.
+    entries which are written again with the same payload keep their extents (and offsets).
+    the superseded extents and indexes are left as dead bytes, which are reclaimed by compaction.
+    """
     OPEN_MODE = "wb"
+    MIN_COMPRESS_SIZE = 256
+    
+    def __init__(self, stored, codec = None, min_size = None, dedup = True, append = False):
+        self._base = None
+        self._base_end = 0
+        self._previous = {}
+        self._code_entries = {} # {source filename: [names of its code entries]} of the blob to be appended
+        self._removed = {} # {filename: number of the entries when it was removed}
+        if append and os.path.isfile(stored) and os.path.getsize(stored):
+            self._base = BlobReader(stored)
+            self._base_end = self._base.end
+        Storage.__init__(self, stored, "r+b" if self._base else None)
+        self.codec = get_codec(codec)
+        self.min_size = self.MIN_COMPRESS_SIZE if min_size is None else min_size
+        self.dedup = dedup
+        self.dedup_count = self.dedup_saved = 0
+        self._extents = {} # {payload digest: (offset, stored length, raw length, codec, crc32)}
+        self._copied = {} # {(source filename, offset, stored length): (offset, stored length, raw length, codec, crc32)}
+        if self._base:
+            # bytes after the trailer in use are left by an unfinished append
+            self.fp.seek(self._base_end)
+            self.fp.truncate()
+            for filename, entry in self._base.entries():
+                if entry.crc32 is None:
+                    # blobs before FORMAT_CHECKSUMS; checksum it once here
+                    entry = entry._replace(crc32 = self._base._crc32_range(entry.offset, entry.length))
+                self._previous[filename] = entry
+                self.files.append((filename, ) + tuple(entry))
+                if filename.startswith(CODE_PREFIX):
+                    self._code_entries.setdefault(filename[len(CODE_PREFIX):].split("/", 1)[-1], []).append(filename)
+        else:
+            self.fp.write(HEADER_MAGIC)
+        self._base_count = len(self.files)
+    
+    def _unchanged(self, filename, size, same_payload):
+        """
+        (internal)
+        returns True if `filename` is in the blob to be appended, and `same_payload(previous)` reports its payload is not changed
+        """
+        previous = self._previous.get(filename, None)
+        if previous is None or (size is not None and size != previous.raw_length):
+            return False
+        return same_payload(previous)
+    
+    def remove(self, filename):
+        """
+        removes the entry from the index; its extent is left as dead bytes
+        """
+        # the entries are filtered on close; the one written after this call is kept
+        self._removed[filename] = len(self.files)
+        self._previous.pop(filename, None)
+    
+    def _supersede(self, filename):
+        """
+        (internal)
+        removes the code objects of `filename` whose payload is being rewritten;
+        they were built from the previous source and would shadow the new one
+        """
+        for name in self._code_entries.pop(filename, ()):
+            self.remove(name)
+    
+    def _live_files(self):
+        """
+        (internal)
+        returns the entries except the removed ones; the entry written again after its removal is kept
+        """
+        removed = self._removed
+        return [ent for i, ent in enumerate(self.files) if i >= removed.get(ent[0], 0)]
+    
+    def _update_fullnames(self):
+        """
+        (internal)
+        keeps the table of Python modules (:data:`FULLNAMES_ENTRY`) of the appended blob in step with its entries;
+        the modules added by the append are listed by :func:`module_fullname`, and the removed ones are dropped.
+        the table which is written explicitly is left as is.
+        """
+        if not self._base or not FULLNAMES_ENTRY in self._base.files:
+            return
+        written = set(ent[0] for ent in self.files[self._base_count:])
+        if FULLNAMES_ENTRY in written:
+            return
+        live = set(ent[0] for ent in self._live_files())
+        table = dict((fullname, (filename, is_package))
+            for fullname, (filename, is_package) in parse_fullnames(self._base.read(FULLNAMES_ENTRY)).items()
+            if filename in live
+        )
+        listed = set(filename for filename, _ in table.values())
+        for filename in written - listed:
+            found = module_fullname(filename) if filename in live else None
+            if found and not found[0] in table:
+                table[found[0]] = (filename, found[1])
+        self.writebytes(FULLNAMES_ENTRY, format_fullnames(sorted(
+            (fullname, filename, is_package) for fullname, (filename, is_package) in table.items()
+        )))
+    
+    def _hasher(self):
+        if not self.dedup:
+            return None
+        import hashlib # only for writing; keeps OpenSSL out of the processes which just read
+        return hashlib.sha256()
+    
+    def _add(self, filename, extent, digest):
+        """
+        (internal)
+        records the entry of the extent, or of the stored extent which has the same `digest`;
+        returns True if the extent is a duplicate (and should be discarded by the caller)
+        """
+        found = self._extents.get(digest, None) if digest is not None else None
+        if found:
+            self.dedup_count += 1
+            self.dedup_saved += extent[1]
+            extent = found
+        elif digest is not None:
+            self._extents[digest] = extent
+        self.files.append((filename, ) + tuple(extent))
+        return bool(found)
     
     def writebytes(self, filename, abuffer):
         assert not "\n" in filename
-        self.files.append((filename, self.fp.tell(), len(abuffer)))
-        self.fp.write(abuffer)
+        if self._unchanged(filename, len(abuffer), lambda previous: self._base.read(filename) == abuffer):
+            return
+        self._supersede(filename)
+        hasher = self._hasher()
+        digest = None
+        if hasher:
+            hasher.update(abuffer)
+            digest = hasher.digest()
+            found = self._extents.get(digest, None)
+            if found:
+                self._add(filename, found, digest)
+                return
+        codec_id, stored = CODEC_STORED, abuffer
+        if self.codec is not None and len(abuffer) >= self.min_size:
+            compressed = self.codec.compress(abuffer)
+            if len(compressed) < len(abuffer):
+                codec_id, stored = self.codec.codec_id, compressed
+        self._add(filename, (self.fp.tell(), len(stored), len(abuffer), codec_id, crc32(stored)), digest)
+        self.fp.write(stored)
     
     def writefile(self, src_filename, filename):
         assert not "\n" in filename
@@ -83,39 +775,151 @@ class BlobWriter(Storage):
         opened = isinstance(src_filename, string_types)
         src = self.sopen(src_filename, "rb") if opened else src_filename
         src_begin = src.tell()
-        src_len = 0
-        for c in self.chunks(src):
-            src_len += len(c)
+        src_size = self._source_size(src, src_begin)
+        if self._unchanged(filename, src_size, lambda previous: self._same_stream(self._base.open(filename), src, src_begin)):
+            if opened:
+                src.close()
+            return
+        self._supersede(filename)
+        codec_id = CODEC_STORED
+        if self.codec is not None and (src_size is None or src_size >= self.min_size):
+            compressor = self.codec.compressobj()
+            hasher = self._hasher()
+            src_len = stored_len = stored_crc = 0
+            for c in self.chunks(src):
+                src_len += len(c)
+                if hasher:
+                    hasher.update(c)
+                c = compressor.compress(c)
+                stored_len += len(c)
+                stored_crc = crc32(c, stored_crc)
+                self.fp.write(c)
+            c = compressor.flush()
+            stored_len += len(c)
+            stored_crc = crc32(c, stored_crc)
             self.fp.write(c)
+            if stored_len < src_len:
+                codec_id = self.codec.codec_id
+            else:
+                # doesn't shrink; rewind and store it as is
+                self.fp.seek(fp_tell)
+                self.fp.truncate()
+                src.seek(src_begin)
+        if codec_id == CODEC_STORED:
+            hasher = self._hasher()
+            src_len = stored_crc = 0
+            for c in self.chunks(src):
+                src_len += len(c)
+                stored_crc = crc32(c, stored_crc)
+                if hasher:
+                    hasher.update(c)
+                self.fp.write(c)
+            stored_len = src_len
         if opened:
             src.close()
         else:
             src.seek(src_begin)
-        self.files.append((filename, fp_tell, src_len))
+        if self._add(filename, (fp_tell, stored_len, src_len, codec_id, stored_crc), hasher.digest() if hasher else None):
+            # the same payload is already stored; discard the one just written
+            self.fp.seek(fp_tell)
+            self.fp.truncate()
+    
+    def copyentry(self, reader, filename, entry = None):
+        """
+        copies the stored bytes of the entry in the :class:`BlobReader` as is (without recompression);
+        the extent is streamed chunk by chunk (and its checksum is verified), and the extent shared by several entries is copied once.
+        """
+        entry = entry if entry is not None else reader.entry(filename)
+        key = (reader.filename, entry.offset, entry.length)
+        copied = self._copied.get(key, None)
+        if copied is None:
+            fp_tell = self.fp.tell()
+            src = EntryIO(reader, entry.offset, entry.length, entry if reader._needs_check(entry) else None)
+            stored_crc = 0
+            for c in self.chunks(src):
+                stored_crc = crc32(c, stored_crc)
+                self.fp.write(c)
+            copied = self._copied[key] = (fp_tell, entry.length, entry.raw_length, entry.codec, stored_crc)
+        self.files.append((filename, ) + copied)
+    
+    def writecode(self, filename, code_or_marshalled, magic = MAGIC_NUMBER):
+        """
+        writes the code object of `filename` next to its source;
+        marshalled bytes built by another interpreter can be written with its `magic`.
+        """
+        if not isinstance(code_or_marshalled, bytes_type):
+            assert magic == MAGIC_NUMBER, "Code object must be marshalled by the interpreter of %r" % (magic, )
+            code_or_marshalled = marshal.dumps(code_or_marshalled)
+        self.writebytes(code_entry_name(filename, magic), code_or_marshalled)
+    
+    def _source_size(self, src, src_begin):
+        """
+        (internal)
+        returns the remaining size of the source file, or None when it's unknown
+        """
+        try:
+            return os.fstat(src.fileno()).st_size - src_begin
+        except (AttributeError, OSError, ValueError):
+            return None
+    
+    def _same_stream(self, a, b, b_begin):
+        """
+        (internal)
+        compares the streams chunk by chunk, and rewinds `b` to `b_begin`
+        """
+        try:
+            for c in self.chunks(b):
+                if a.read(len(c)) != c:
+                    return False
+            return not a.read(1)
+        finally:
+            a.close()
+            b.seek(b_begin)
+    
+    def __exit__(self, etype, einst, etrace):
+        if etype is None:
+            self.close()
+        else:
+            self.abort()
+    
+    def abort(self):
+        """
+        discards the entries written so far;
+        the blob to be appended is truncated back to its previous trailer, and the new blob is left empty.
+        """
+        self.fp.truncate(self._base_end)
+        Storage.close(self)
+        if self._base:
+            self._base.close()
+            self._base = None
     
     def close(self):
+        # the data body is already in place; append the journal and the footer which points to it
+        self._update_fullnames()
+        index_offset = self.fp.tell()
+        index = format_index(self._live_files())
+        self.fp.write(index)
+        self.fp.write(FOOTER.pack(FOOTER_MAGIC, FORMAT_VERSION, index_offset, len(index)))
         Storage.close(self)
-        with_journal_stored = self.filename + ".tmp"
-        with self.sopen(with_journal_stored, "wb", buffering = 1024 * 10) as tmpfp:
-            tmpfp.write(
-                ensure_bytes(
-                    LINEEND.join(
-                        ("%s%s%s%s%s" % (fn, LINEEND, fp, LINEEND, fz) for fn, fp, fz in self.files)
-                    )
-                )
-            )
-            tmpfp.write(bLINEEND2)
-            with self.sopen(self.filename, "rb") as dfp:
-                for c in self.chunks(dfp):
-                    tmpfp.write(c)
-        import os
-        os.remove(self.filename)
-        os.rename(with_journal_stored, self.filename)
+        if self._base:
+            self._base.close()
+            self._base = None
 
 class BlobReader(Storage):
+    """
+    reader of the blob file;
+    with `mapped` (default), the whole file is memory-mapped and entries are sliced out of the mapping,
+    so the page cache is shared between the processes which read the same blob.
+    
+    reads never share a file position, so several threads can read at once without locking;
+    the unmapped reader uses :func:`os.pread`, or per-thread file handles where it's unavailable.
+    
+    checksums of the entries are verified lazily on the first read of each extent,
+    and :func:`verify` checks all of them at once.
+    """
     OPEN_MODE = "rb"
     
-    def __init__(self, stored):
+    def __init__(self, stored, mapped = True):
         # find CR+CR, and set seekpos
         def _find_crcr_text():
             lines = b""
@@ -123,7 +927,6 @@ class BlobReader(Storage):
                 while True:
                     buf = fp.read(self.BUFFERING)
                     if not buf:
-                        print(lines)
                         raise ValueError("Invalid file; No journal parts")
                     lines += buf
                     p = lines.find(bLINEEND2)
@@ -131,26 +934,529 @@ class BlobReader(Storage):
                         lines = lines[:p]
                         break
             offset = len(lines) + len(bLINEEND2)
-            lines = ensure_text(lines).split(LINEEND)
-            files = dict(
-                    zip(
-                    lines[::3],
-                    zip(
-                        map((lambda s: int(s) + offset), lines[1::3]),
-                        map((lambda s: int(s)), lines[2::3])
-                    )
-                )
-            )
-            return files, offset
+            return parse_journal(lines, offset), offset
         Storage.__init__(self, stored)
-        self.files, self._offset = _find_crcr_text()
+        self.mapped = mapped
+        self._map = None
+        self._local = threading.local()
+        self._local_fps = []
+        self._local_lock = threading.Lock()
+        self._verified = set() # (offset, length) of the extents whose checksum is verified
+        self._tree = None
+        self.recorder = None # callable which is called with the name of each entry to read; see also :func:`prefetch`
+        footer = self._read_footer()
+        if mapped or (footer and footer[0] >= FORMAT_BINARY_INDEX):
+            self._map = mmap.mmap(self.fp.fileno(), 0, access = mmap.ACCESS_READ)
+        if footer:
+            self.version, index_offset, index_length, self.end = footer
+            self._offset = 0
+            if self.version >= FORMAT_BINARY_INDEX:
+                # the index is looked up in place; only the pages touched by the binary search are read
+                self.files = BinaryIndex(self._map, index_offset, self.version)
+            else:
+                self.fp.seek(index_offset)
+                self.files = parse_journal(self.fp.read(index_length))
+        else:
+            self.version = FORMAT_HEADER_JOURNAL
+            self.files, self._offset = _find_crcr_text()
+            self.end = os.fstat(self.fp.fileno()).st_size
     
-    def read(self, filename):
-        found = self.files.get(filename, None)
+    def _read_footer(self):
+        """
+        (internal)
+        returns (format version, index offset, index length, end of the footer) of the trailer-indexed blob,
+        or None for the legacy header-journal blob.
+        
+        the footer at the end of the file is missing (or partial) while an append is being written, or after an unfinished one;
+        the last valid footer before it is used then, which reads the blob as it was before the append.
+        """
+        self.fp.seek(0, os.SEEK_END)
+        size = self.fp.tell()
+        if size < FOOTER.size:
+            return None
+        self.fp.seek(-FOOTER.size, os.SEEK_END)
+        footer = self._parse_footer(self.fp.read(FOOTER.size), size - FOOTER.size)
+        if footer:
+            return footer
+        self.fp.seek(0)
+        headed = self.fp.read(len(HEADER_MAGIC)) == HEADER_MAGIC
+        scan = mmap.mmap(self.fp.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            end = size - FOOTER.size
+            while True:
+                position = scan.rfind(FOOTER_MAGIC, 0, end)
+                if position < 0:
+                    break
+                footer = self._parse_footer(scan[position:position + FOOTER.size], position)
+                if footer:
+                    return footer
+                end = position + len(FOOTER_MAGIC) - 1
+        finally:
+            scan.close()
+        if headed:
+            raise ValueError("Invalid blob; no valid footer (the blob is being written, or its writing was not finished)")
+        return None
+    
+    def _parse_footer(self, data, position):
+        """
+        (internal)
+        returns (format version, index offset, index length, end of the footer) if `data` is the footer at `position`, which follows its index
+        """
+        if len(data) < FOOTER.size:
+            return None
+        magic, version, index_offset, index_length = FOOTER.unpack(data[:FOOTER.size])
+        if magic != FOOTER_MAGIC or index_offset + index_length != position:
+            return None
+        if version > FORMAT_VERSION:
+            raise ValueError("Unsupported blob format version %d" % version)
+        return version, index_offset, index_length, position + FOOTER.size
+    
+    def close(self):
+        if self._map is not None:
+            self.files = {}
+            try:
+                self._map.close()
+            except BufferError:
+                # views returned by `read_view` are still alive; the mapping is released with the last of them
+                pass
+            self._map = None
+        with self._local_lock:
+            for fp in self._local_fps:
+                fp.close()
+            del self._local_fps[:]
+        Storage.close(self)
+    
+    def entry(self, filename):
+        """
+        returns the :class:`Entry` of `filename`, or raises ValueError if no such entry
+        """
+        if self.recorder is not None:
+            self.recorder(filename)
+        if isinstance(self.files, BinaryIndex):
+            found = self.files.entry(filename)
+        else:
+            found = self.files.get(filename, None)
+            if found:
+                found = Entry(found[0], found[1], found[1], CODEC_STORED, None)
         if not found:
             raise ValueError("No such entry %s" % filename)
-        # TODO: lock?
-        fseek, flen = found
-        self.fp.seek(fseek)
-        return self.fp.read(flen)
-        
+        return found
+    
+    def entries(self):
+        """
+        iterates (filename, :class:`Entry`) tuples of all entries
+        """
+        if isinstance(self.files, BinaryIndex):
+            for ent in self.files.entries():
+                yield ent
+        else:
+            for filename, (offset, length) in self.files.items():
+                yield filename, Entry(offset, length, length, CODEC_STORED, None)
+    
+    def _listdir(self, dirname):
+        if isinstance(self.files, BinaryIndex) and self.files.has_directories:
+            return self.files.listdir(dirname)
+        if self._tree is None:
+            self._tree = DirectoryTree(self.files)
+        return self._tree.listdir(dirname)
+    
+    def listdir(self, prefix = ""):
+        """
+        returns the sorted base names of the entries and the directories just under `prefix` (e.g. "pkg/sub/"),
+        or raises ValueError if no such directory;
+        it costs time proportional to the number of the children, with the directory table of the blob.
+        """
+        found = self._listdir(prefix)
+        if found is None:
+            raise ValueError("No such directory %s" % prefix)
+        dirnames, filenames = found
+        return sorted(dirnames + filenames)
+    
+    def walk(self, top = ""):
+        """
+        iterates (directory name, directory names, file names) tuples of the directory tree under `top`, top-down like :func:`os.walk`;
+        directory names are joined with "/", and the root directory is the empty name.
+        the directory names in the tuple can be modified in place to prune the walk.
+        """
+        found = self._listdir(top)
+        if found is None:
+            return
+        dirpath = split_dirname(top)
+        dirnames, filenames = found
+        yield dirpath, dirnames, filenames
+        for dirname in dirnames:
+            for walked in self.walk(dirpath + "/" + dirname if dirpath else dirname):
+                yield walked
+    
+    def _needs_check(self, entry):
+        return entry.crc32 is not None and not entry[:2] in self._verified
+    
+    def _check(self, entry, value):
+        """
+        (internal)
+        marks the extent of `entry` as verified, or raises :class:`CorruptedEntryError` if `value` is not its checksum
+        """
+        if value != entry.crc32:
+            raise CorruptedEntryError("Checksum mismatch at offset %d of %s: expected %08x, but %08x" % (
+                entry.offset, self.filename, entry.crc32, value
+            ))
+        self._verified.add(entry[:2])
+    
+    def _read_stored(self, entry):
+        stored = self._read_range(entry.offset, entry.length)
+        if self._needs_check(entry):
+            self._check(entry, crc32(stored))
+        return stored
+    
+    def _read_range(self, offset, length):
+        if self.mapped:
+            return self._map[offset:offset + length]
+        return self._pread(offset, length)
+    
+    def read(self, filename):
+        entry = self.entry(filename)
+        stored = self._read_stored(entry)
+        if entry.codec == CODEC_STORED:
+            return stored
+        return get_codec(entry.codec).decompress(stored)
+    
+    def open(self, filename):
+        """
+        returns a read-only, seekable file-like object of the entry, which streams the entry without loading it whole;
+        compressed entries are decompressed while reading.
+        """
+        entry = self.entry(filename)
+        stored = EntryIO(self, entry.offset, entry.length, entry if self._needs_check(entry) else None)
+        if entry.codec == CODEC_STORED:
+            return stored
+        return DecompressingEntryIO(stored, get_codec(entry.codec), entry.raw_length)
+    
+    if hasattr(os, "pread"):
+        def _pread(self, offset, length):
+            """
+            (internal)
+            positional read which does not move the shared file position
+            """
+            fd = self.fp.fileno()
+            buf = os.pread(fd, length, offset)
+            if len(buf) == length:
+                return buf
+            bufs = [buf]
+            while buf and length > 0:
+                length -= len(buf)
+                offset += len(buf)
+                buf = os.pread(fd, length, offset)
+                bufs.append(buf)
+            return b"".join(bufs)
+    else:
+        def _pread(self, offset, length):
+            """
+            (internal)
+            positional read with the file handle which is owned by the current thread
+            """
+            fp = getattr(self._local, "fp", None)
+            if fp is None:
+                fp = self._local.fp = self.sopen(self.filename, "rb", buffering = -1)
+                with self._local_lock:
+                    self._local_fps.append(fp)
+            fp.seek(offset)
+            return fp.read(length)
+    
+    def read_view(self, filename):
+        """
+        returns the entry as a :class:`memoryview`;
+        the view refers to the mapped file directly (zero-copy) when this reader is `mapped`,
+        and the entry is not compressed.
+        """
+        entry = self.entry(filename)
+        if self.mapped and entry.codec == CODEC_STORED:
+            view = memoryview(self._map_range(entry.offset, entry.length))
+            if self._needs_check(entry):
+                self._check(entry, crc32(view))
+            return view
+        return memoryview(self.read(filename))
+    
+    def _map_range(self, offset, length):
+        """
+        (internal)
+        returns the range of the mapped file; zero-copy where the mapping supports the buffer protocol,
+        or a copy of the range (mmap of Python 2)
+        """
+        try:
+            return memoryview(self._map)[offset:offset + length]
+        except TypeError:
+            return self._map[offset:offset + length]
+    
+    def _crc32_range(self, offset, length):
+        value = 0
+        end = offset + length
+        while offset < end:
+            size = min(self.BUFFERING, end - offset)
+            if self.mapped:
+                value = crc32(self._map_range(offset, size), value)
+            else:
+                value = crc32(self._pread(offset, size), value)
+            offset += size
+        return value
+    
+    def prefetch(self, filenames):
+        """
+        asks the OS to read ahead the extents of `filenames` (e.g. the access order recorded by :data:`recorder`),
+        so the following reads of them hit the page cache;
+        `madvise(MADV_WILLNEED)` is used for the mapped reader, `posix_fadvise(POSIX_FADV_WILLNEED)` for the others,
+        or a background thread reads them sequentially where neither is available.
+        unknown names are ignored, and returns the number of bytes to read ahead.
+        """
+        extents = []
+        for filename in filenames:
+            if filename in self.files:
+                entry = self.entry(filename)
+                extents.append((entry.offset, entry.offset + entry.length))
+        # coalesce the neighbours; a few small gaps are cheaper than separate requests
+        ranges = []
+        for begin, end in sorted(extents):
+            if ranges and begin <= ranges[-1][1] + PREFETCH_GAP:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([begin, end])
+        if self._map is not None and hasattr(self._map, "madvise") and hasattr(mmap, "MADV_WILLNEED"):
+            for begin, end in ranges:
+                aligned = begin - begin % mmap.PAGESIZE
+                self._map.madvise(mmap.MADV_WILLNEED, aligned, end - aligned)
+        elif hasattr(os, "posix_fadvise"):
+            fd = self.fp.fileno()
+            for begin, end in ranges:
+                os.posix_fadvise(fd, begin, end - begin, os.POSIX_FADV_WILLNEED)
+        else:
+            def read_ahead():
+                try:
+                    for begin, end in ranges:
+                        while begin < end:
+                            size = min(self.BUFFERING, end - begin)
+                            self._read_range(begin, size)
+                            begin += size
+                except (IOError, OSError, ValueError):
+                    pass # the reader is closed
+            thread = threading.Thread(target = read_ahead, name = "blob-prefetch")
+            thread.daemon = True
+            thread.start()
+        return sum(end - begin for begin, end in ranges)
+    
+    def verify(self, workers = None):
+        """
+        verifies the checksums of all extents in parallel with `workers` threads (the number of CPUs by default);
+        returns the sorted list of the names of corrupted entries;
+        the other errors raised while checking are re-raised after all workers finished.
+        """
+        extents = {}
+        for filename, entry in self.entries():
+            if entry.crc32 is not None:
+                extents.setdefault(entry, []).append(filename)
+        pending = list(extents)
+        corrupted, errors = [], []
+        lock = threading.Lock()
+        def work():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    entry = pending.pop()
+                try:
+                    self._check(entry, self._crc32_range(entry.offset, entry.length))
+                except CorruptedEntryError:
+                    with lock:
+                        corrupted.extend(extents[entry])
+                except BaseException as e:
+                    with lock:
+                        errors.append(e)
+                        del pending[:]
+                    return
+        workers = workers or getattr(os, "cpu_count", lambda: None)() or 4
+        threads = [threading.Thread(target = work) for _ in range(min(workers, len(pending)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return sorted(corrupted)
+
+class ShardedBlobWriter(object):
+    """
+    writer of the sharded blob;
+    entries are split into the shard files (`stored` + ".000", ".001", ...), which are written by :class:`BlobWriter`,
+    and the top-level index `stored` maps each entry name to its shard.
+    
+    with `shard_by` = "size", a new shard is started when the current one exceeds `shard_size` bytes;
+    with `shard_by` = "package", entries are distributed into `shards` shards by their top-level package,
+    so a process which uses a few packages opens only their shards.
+    `options` are passed to :class:`BlobWriter` of each shard.
+    """
+    SHARD_SIZE = 1024 * 1024 * 256
+    
+    def __init__(self, stored, shard_by = "size", shards = 8, shard_size = None, **options):
+        assert shard_by in ("size", "package"), "Unknown shard_by %r" % (shard_by, )
+        self.filename = stored
+        self.shard_by = shard_by
+        self.shards = int(shards)
+        self.shard_size = int(shard_size or self.SHARD_SIZE)
+        self.options = options
+        self.index = BlobWriter(stored)
+        self.shard_filenames = []
+        self._writers = {}
+        self._current = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, etype, einst, etrace):
+        if etype is None:
+            self.close()
+        else:
+            self.abort()
+    
+    def abort(self):
+        for writer in self._writers.values():
+            writer.abort()
+        self.index.abort()
+    
+    @property
+    def dedup_count(self):
+        return sum(w.dedup_count for w in self._writers.values())
+    
+    @property
+    def dedup_saved(self):
+        return sum(w.dedup_saved for w in self._writers.values())
+    
+    def _shard_of(self, filename):
+        """
+        (internal)
+        returns the shard number of the entry
+        """
+        if self.shard_by == "package":
+            if filename.startswith(CODE_PREFIX):
+                # code objects follow their sources; strip "__amp__/code/<magic>/"
+                filename = filename[len(CODE_PREFIX):].split("/", 1)[-1]
+            return crc32(ensure_bytes(filename.split("/", 1)[0])) % self.shards
+        if self._current is None or self._writers[self._current].fp.tell() >= self.shard_size:
+            self._current = len(self._writers)
+        return self._current
+    
+    def _writer(self, filename):
+        shard = self._shard_of(filename)
+        writer = self._writers.get(shard, None)
+        if writer is None:
+            writer = self._writers[shard] = BlobWriter("%s.%03d" % (self.filename, shard), **self.options)
+            self.shard_filenames.append(writer.filename)
+        self.index.writebytes(filename, ensure_bytes(".%03d" % shard))
+        return writer
+    
+    def writebytes(self, filename, abuffer):
+        self._writer(filename).writebytes(filename, abuffer)
+    
+    def writefile(self, src_filename, filename):
+        self._writer(filename).writefile(src_filename, filename)
+    
+    def writecode(self, filename, code_or_marshalled, magic = MAGIC_NUMBER):
+        name = code_entry_name(filename, magic)
+        self._writer(name).writecode(filename, code_or_marshalled, magic)
+    
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        suffixes = [fn[len(self.filename):] for fn in self.shard_filenames]
+        self.index.writebytes(SHARDS_ENTRY, ensure_bytes(LINEEND.join(suffixes)))
+        self.index.close()
+
+class ShardedBlobReader(object):
+    """
+    reader of the sharded blob;
+    only the top-level index is opened at first, and each shard is opened on the first read of its entries.
+    `options` are passed to :class:`BlobReader` of each shard.
+    """
+    def __init__(self, index, **options):
+        self.index = index
+        self.filename = index.filename
+        self.files = index.files
+        self.options = options
+        self._shards = {}
+        self._lock = threading.Lock()
+        self.recorder = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, etype, einst, etrace):
+        self.close()
+    
+    def shard(self, filename):
+        """
+        returns the :class:`BlobReader` of the shard which has the entry
+        """
+        if self.recorder is not None:
+            self.recorder(filename)
+        suffix = ensure_text(self.index.read(filename))
+        shard = self._shards.get(suffix, None)
+        if shard is None:
+            with self._lock:
+                shard = self._shards.get(suffix, None)
+                if shard is None:
+                    shard = self._shards[suffix] = BlobReader(self.filename + suffix, **self.options)
+        return shard
+    
+    def shard_suffixes(self):
+        return [ensure_text(suffix) for suffix in self.index.read(SHARDS_ENTRY).split(bLINEEND) if suffix]
+    
+    def entry(self, filename):
+        return self.shard(filename).entry(filename)
+    
+    def entries(self):
+        for filename in self.files:
+            if filename != SHARDS_ENTRY:
+                yield filename, self.entry(filename)
+    
+    def listdir(self, prefix = ""):
+        return self.index.listdir(prefix)
+    
+    def walk(self, top = ""):
+        return self.index.walk(top)
+    
+    def read(self, filename):
+        return self.shard(filename).read(filename)
+    
+    def read_view(self, filename):
+        return self.shard(filename).read_view(filename)
+    
+    def open(self, filename):
+        return self.shard(filename).open(filename)
+    
+    def prefetch(self, filenames):
+        shards = {}
+        for filename in filenames:
+            if filename in self.files:
+                shards.setdefault(self.shard(filename), []).append(filename)
+        return sum(shard.prefetch(names) for shard, names in shards.items())
+    
+    def verify(self, workers = None):
+        corrupted = []
+        for suffix in self.shard_suffixes():
+            with BlobReader(self.filename + suffix, **self.options) as shard:
+                corrupted.extend(shard.verify(workers))
+        return sorted(corrupted)
+    
+    def close(self):
+        with self._lock:
+            for shard in self._shards.values():
+                shard.close()
+            self._shards.clear()
+        self.index.close()
+
+def open_blob(stored, **options):
+    """
+    opens the blob file;
+    returns :class:`ShardedBlobReader` for the top-level index of the sharded blob, or :class:`BlobReader` for the others
+    """
+    reader = BlobReader(stored, **options)
+    if SHARDS_ENTRY in reader.files:
+        return ShardedBlobReader(reader, **options)
+    return reader
@@ -13,11 +13,15 @@ import functools
 import itertools
 import json
 import os
+import random
 import sys
 import tempfile
+import threading
+import time
 import types
 import zipfile
 
+from amp.bootup import ampimporter, blobstore
 from amp.core import siteconfig, slackcommands, utils
 
 commands = slackcommands.SlackCommand()
@@ -116,6 +120,144 @@ def compose(config = None, targets = None):
     return siteconf.dump(targets, "BlobStoreResourceComposer")
     #return siteconf.dump(targets, "ZipResourceComposer")
 
+def _compact_blob(source, target, ranks = None):
+    """
+    (internal)
+    `source` のblobファイルの有効なエントリのみを `target` へ書き出し、エントリ数を得る
+    `compact` コマンドで使用
+    """
+    with blobstore.BlobReader(source) as reader:
+        entries = sorted(reader.entries(), key = lambda ent: ent[1].offset)
+        if ranks is not None:
+            entries.sort(key = lambda ent: ranks.get(ent[0], len(ranks))) # stable; the others keep their current order
+        with blobstore.BlobWriter(target) as writer:
+            for filename, entry in entries:
+                writer.copyentry(reader, filename, entry)
+    return len(entries)
+
+@commands.mark("compact")
+def compact(blob = None, output = None, order = None):
+    """
+    Compact the blob file; only the live entries are rewritten, so dead extents which are left by appending are reclaimed.
+    Entries are streamed as they are stored (without recompression), so the memory usage is bounded.
+    Each shard of the sharded blob is compacted along with its top-level index.
+    
+    :param blob: blob file path
+    :param output: output blob file path; `blob` is replaced with the compacted one if value is None (default).
+    :param order: text file path which lists entry names in the access order (one name per line); the listed entries are placed first in this order, followed by the others in their current order.
+    :return: dict of the file sizes before/after the compaction, and the reclaimed bytes
+    """
+    assert blob, "No blob file"
+    compacted = output or (blob + ".compact")
+    ranks = None
+    if order:
+        ranks = {}
+        with open(order, "r") as fp:
+            for name in fp:
+                ranks.setdefault(name.rstrip("\r\n"), len(ranks))
+    with blobstore.open_blob(blob) as reader:
+        suffixes = reader.shard_suffixes() if isinstance(reader, blobstore.ShardedBlobReader) else []
+    shards = [(blob + suffix, compacted + suffix) for suffix in suffixes]
+    entries = sum(_compact_blob(source, target, ranks) for source, target in shards)
+    indexed = _compact_blob(blob, compacted, ranks)
+    entries = entries if shards else indexed
+    pairs = shards + [(blob, compacted)]
+    before = sum(os.path.getsize(source) for source, _ in pairs)
+    after = sum(os.path.getsize(target) for _, target in pairs)
+    if not output:
+        # each file is swapped atomically; the shards are swapped before the index which refers to them
+        for source, target in pairs:
+            getattr(os, "replace", os.rename)(target, source)
+    return dict(
+        blob = output or blob,
+        entries = entries,
+        before = before,
+        after = after,
+        reclaimed = before - after,
+    )
+
+@commands.mark("import-stress")
+def import_stress(threads = 16, modules = 200, rounds = 5, seed = 0):
+    """
+    Stress benchmark of the concurrent imports from the blob.
+    `threads` threads import overlapping sets of `modules` generated modules (which import each other) at once,
+    half of them through the import statement and the others through the legacy `load_module`;
+    each module body must be executed once per round, and must never be seen half-built.
+    
+    :param threads: number of the importing threads
+    :param modules: number of the generated modules
+    :param rounds: number of the rounds; all of the generated modules are unloaded between the rounds
+    :param seed: random seed of the import orders
+    :return: dict of the elapsed time, the number of imports, and the numbers of duplicated executions and half-built modules
+    """
+    threads, modules, rounds = int(threads), int(modules), int(rounds)
+    rand = random.Random(int(seed))
+    counter = types.ModuleType("_amp_stress_counter")
+    counter.lock = threading.Lock()
+    counter.executed = collections.Counter()
+    def hit(fullname):
+        with counter.lock:
+            counter.executed[fullname] += 1
+    counter.hit = hit
+    names = ["_amp_stress_m%d" % i for i in range(modules)]
+    blobfile = tempfile.NamedTemporaryFile("wb", delete = False).name
+    with blobstore.BlobWriter(blobfile) as writer:
+        for i, name in enumerate(names):
+            body = [
+                "import sys, time",
+                "sys.modules['_amp_stress_counter'].hit(__name__)",
+                "time.sleep(0.0005) # widen the window of the race",
+            ]
+            if i:
+                body.append("import %s" % names[i // 2])
+            body.append("DONE = True")
+            writer.writebytes(name + ".py", utils.ensure_bytes("\n".join(body)))
+    finder = ampimporter.AMPStackedFinder("/amp-stress")
+    finder.register(ampimporter.AMPBlobStoreImporter(blobfile))
+    sys.modules[counter.__name__] = counter
+    sys.meta_path.insert(0, finder)
+    duplicated = halfbuilt = imports = 0
+    elapsed = 0.0
+    try:
+        for _ in range(rounds):
+            orders = [rand.sample(names, (modules + 1) // 2) for _ in range(threads)]
+            seen = []
+            def work(order, legacy):
+                for name in order:
+                    if legacy:
+                        module = finder.find_module(name).load_module(name)
+                    else:
+                        module = __import__(name)
+                    seen.append(getattr(module, "DONE", False))
+            workers = [threading.Thread(target = work, args = (order, i % 2)) for i, order in enumerate(orders)]
+            begin = time.time()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed += time.time() - begin
+            imports += len(seen)
+            halfbuilt += seen.count(False)
+            duplicated += sum(count - 1 for count in counter.executed.values())
+            counter.executed.clear()
+            for name in names:
+                sys.modules.pop(name, None)
+    finally:
+        sys.meta_path.remove(finder)
+        sys.modules.pop(counter.__name__, None)
+        finder.importers[0].br.close()
+        os.remove(blobfile)
+    return dict(
+        threads = threads,
+        modules = modules,
+        rounds = rounds,
+        imports = imports,
+        elapsed = elapsed,
+        imports_per_sec = imports / elapsed if elapsed else None,
+        duplicated = duplicated,
+        halfbuilt = halfbuilt,
+    )
+
 if __name__ == '__main__':
     try:
         r = commands.parse(sys.argv[1:], args_encoding = getattr(sys.stdin, "encoding", sys.getdefaultencoding()))()
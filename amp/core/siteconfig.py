@@ -15,6 +15,7 @@ import zipfile
 
 from amp.core import utils, template_bootstrap
 import amp.bootup as bootup
+from amp.bootup import blobstore
 
 class SiteConfiguration(utils.AutoDict):
     """
@@ -104,6 +105,12 @@ class OutputConfiguration(utils.AutoDict):
         modules = "py"
         distname = "dist.json"
         filename = "out.zip"
+        blob_codec = "zlib" # BLOBの要素ごとの圧縮形式; "zlib", "bz2", "lzma" または null(無圧縮)
+        blob_codec_min_size = 256 # このサイズ未満の要素は圧縮しない
+        precompile = True # BLOBへ Pythonモジュールのコードオブジェクトを、このインタプリタの MAGIC_NUMBERごとに格納する
+        blob_shard_by = None # BLOBをシャードに分割する方法; "size", "package" または null(分割しない)
+        blob_shards = 8 # blob_shard_by = "package" の場合のシャード数
+        blob_shard_size = 1024 * 1024 * 256 # blob_shard_by = "size" の場合のシャードの大きさ
     
     def configured(self):
         assert self.modules, "No `modules` configuration"
@@ -195,6 +202,9 @@ class PythonPackingConfiguration(PackingConfigration):
         modname = relfilename.basename().split(".")[0]
         pkgname = relfilename.dirname().replace("/", ".")
         return (pkgname + "." + modname) if pkgname else modname
+    
+    # e.g path/to/module/foo.cpython-38-x86_64-linux-gnu.so => path.to.module.foo
+    so_to_fullname = pyd_to_fullname
     #endregion 相対ファイルパスから完全名を生成する
     
     def dump_to(self, dumpobj):
@@ -314,6 +324,8 @@ class ZipResourceComposer(AbstractResourceComposer):
     :func:`~write_depends` で Pythonのローダで読み込めない依存コンテンツを ZIP内ファイルとして格納する。
     wip
     """
+    MODULES_COMPRESS_TYPE = zipfile.ZIP_DEFLATED #: ZIP内に格納する「Pythonモジュール」のコンテナの圧縮形式
+    
     def __init__(self, siteconf, **options):
         AbstractResourceComposer.__init__(self, siteconf, **options)
         self.modules = utils.ZipOutput(compress = zipfile.ZIP_STORED)
@@ -347,6 +359,13 @@ class ZipResourceComposer(AbstractResourceComposer):
         print("DumpObject.write_depends%s -> %s" % (filename, arcname))
         self.zout.writefile(filename, arcname)
     
+    def write_modules_container(self, modules):
+        """
+        「Pythonモジュール」のコンテナを ZIPへ格納する
+        """
+        print("Adding %s" % self.siteconf.outputs.modules)
+        self.zout.writefile(modules.filename, self.siteconf.outputs.modules, self.MODULES_COMPRESS_TYPE)
+    
     def close(self):
         """
         このストレージへの格納を完了し、AMPのパッケージファイルを生成する
@@ -355,8 +374,7 @@ class ZipResourceComposer(AbstractResourceComposer):
             return
         self.__closed = True
         with self.modules.finishing() as modules:
-            print("Adding %s" % self.siteconf.outputs.modules)
-            self.zout.writefile(modules.filename, self.siteconf.outputs.modules)
+            self.write_modules_container(modules)
             print("Adding %s" % self.siteconf.outputs.distname)
             with self.zout.open(self.siteconf.outputs.distname, "w") as fp:
                 fp.write(utils.short_json_encoder.encode(self.dist))
@@ -384,7 +402,61 @@ class BlobStoreResourceComposer(ZipResourceComposer):
     このストレージは :func:`~write_python` で Pythonのローダで読み込み可能なモジュールを「Pythonモジュール」として Blob-in-ZIPとして格納し、
     :func:`~write_depends` で Pythonのローダで読み込めない依存コンテンツを ZIP内ファイルとして格納する。
     (agonist of DumpObject)
+    
+    BLOBの要素は個別に圧縮されるため、BLOB自体は ZIP内に無圧縮で格納され、展開せずに読み込める。
     """
+    MODULES_COMPRESS_TYPE = zipfile.ZIP_STORED
+    
     def __init__(self, siteconf, **options):
         ZipResourceComposer.__init__(self, siteconf, **options)
-        self.modules = utils.WrappedBlobWriter()
+        outputs = self.siteconf.outputs
+        writer_options = dict(
+            codec = outputs.blob_codec,
+            min_size = outputs.blob_codec_min_size,
+        )
+        if outputs.blob_shard_by:
+            writer_options.update(
+                shard_by = outputs.blob_shard_by,
+                shards = outputs.blob_shards,
+                shard_size = outputs.blob_shard_size,
+            )
+        self.modules = utils.WrappedBlobWriter(**writer_options)
+    
+    def write_fullnames(self):
+        """
+        コンテナ内に格納された Pythonモジュールの完全名の表(`dist.files` から作成される)を、コンテナへ格納する;
+        インポータはこの表を参照し、モジュールのファイルパスを探索せずに解決する
+        """
+        table = []
+        for stored_filename, (fullname, containersafe) in self.dist.files.items():
+            if fullname and containersafe:
+                table.append((fullname, stored_filename, utils.FilePath.ensure(stored_filename).namepart() == "__init__"))
+        self.modules.writebytes(blobstore.FULLNAMES_ENTRY, blobstore.format_fullnames(sorted(table)))
+    
+    def close(self):
+        if not self.modules.is_closed:
+            self.write_fullnames()
+        ZipResourceComposer.close(self)
+    
+    def write_modules_container(self, modules):
+        """
+        「Pythonモジュール」のコンテナ(シャードに分割されている場合は、トップレベルのインデクスと各シャード)を ZIPへ格納する
+        """
+        ZipResourceComposer.write_modules_container(self, modules)
+        for suffix, volume in modules.volumes:
+            print("Adding %s%s" % (self.siteconf.outputs.modules, suffix))
+            self.zout.writefile(volume, self.siteconf.outputs.modules + suffix, self.MODULES_COMPRESS_TYPE)
+    
+    def write_python(self, filename, modpath, fullname = None, containersafe = True):
+        """
+        このストレージへ Pythonモジュールを格納する;
+        `outputs.precompile` が有効であれば、コンテナ内に格納されるソースのコードオブジェクトも格納する
+        """
+        ZipResourceComposer.write_python(self, filename, modpath, fullname, containersafe)
+        if containersafe and self.siteconf.outputs.precompile and modpath.endswith(".py"):
+            try:
+                code = compile(filename.read(), modpath.to_fsstr(), "exec", dont_inherit = True)
+            except (SyntaxError, ValueError) as e:
+                print("(skip precompiling %s: %s)" % (filename, e))
+                return
+            self.modules.raw_blobwriter.writecode(modpath, code)
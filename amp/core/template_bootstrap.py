@@ -49,51 +49,125 @@ def startup():
     os.environ["PATH"] = os.pathsep.join(unique_list_add(os.environ["PATH"].split(os.pathsep), EXPAND_DIR))
     unique_list_add(sys.path, PYMODULE_CONTAINER, EXPAND_DIR)
     
-    import imp
+    try:
+        from importlib.machinery import ExtensionFileLoader, SourceFileLoader
+        from importlib.util import module_from_spec, spec_from_file_location
+        imp = None
+    except ImportError:
+        import imp # Python 2
+    
+    def file_loader(fullname, filepath):
+        return (SourceFileLoader if filepath.endswith(".py") else ExtensionFileLoader)(fullname, filepath)
+    
+    def load_file(fullname, filepath):
+        # counterpart of imp.load_source/imp.load_dynamic
+        spec = spec_from_file_location(fullname, filepath, loader = file_loader(fullname, filepath))
+        module = module_from_spec(spec)
+        sys.modules[fullname] = module
+        try:
+            spec.loader.exec_module(module)
+        except:
+            sys.modules.pop(fullname, None)
+            raise
+        return module
+    
+    def raw_importer(filepath):
+        if imp is None:
+            return load_file
+        return imp.load_source if filepath.endswith(".py") else imp.load_dynamic
+    
+    def build_index(files, expand_dir):
+        # {{fullname: (file path, is package)}} of the Python modules in `expand_dir`, from `files` of the distribution
+        index = {{}}
+        for stored_filename, (fullname, containersafe) in files.items():
+            if fullname and not containersafe:
+                index[fullname] = (
+                    joinpath(stored_filename, basedir = expand_dir),
+                    os.path.basename(stored_filename).startswith("__init__."),
+                )
+        return index
+    
     class BehalfImporter(object):
-        RAW_IMPORTER_MAP = {{
-            ".py": imp.load_source,
-            ".pyd": imp.load_dynamic,
-            ".dll": imp.load_dynamic,
-            ".so": imp.load_dynamic,
-        }}
-        
+        # local_hooks.find_module(importer, fullname, path, filepath) returns the loader of the module, or a false value to decline it;
+        # local_hooks.load_module(importer, fullname, filepath, rawimp) is called for the modules whose loader is the importer,
+        # and returns the loaded module, or a false value to load it by `rawimp(fullname, filepath)`
         def __init__(
                 self,
                 import_base_dir = None,
                 local_hooks = None,
+                index = None,
             ):
             self.import_base_dir = import_base_dir or EXPAND_DIR
             self.local_hooks = local_hooks
+            # modules are looked up in the index without touching the file system
+            self.index = index if index is not None else build_index(DISTRIBUTION["files"], self.import_base_dir)
         
         def __eq__(self, value):
             return isinstance(value, self.__class__) and self.import_base_dir == value.import_base_dir
         
+        def find(self, fullname, path = None):
+            # returns (loader, file path, is package) of the module
+            found = self.index.get(fullname, None)
+            if not found:
+                return None
+            filepath, is_package = found
+            if not self.local_hooks:
+                return (None, filepath, is_package)
+            loader = self.local_hooks.find_module(self, fullname, path, filepath)
+            return (loader, filepath, is_package) if loader else None
+        
+        def find_spec(self, fullname, path = None, target = None):
+            found = self.find(fullname, path)
+            if not found:
+                return None
+            loader, filepath, is_package = found
+            return spec_from_file_location(
+                fullname,
+                filepath,
+                loader = loader or file_loader(fullname, filepath),
+                submodule_search_locations = [os.path.dirname(filepath)] if is_package else None,
+            )
+        
+        def create_module(self, spec):
+            # the module accepted by local_hooks with this importer as its loader
+            module = self.local_hooks.load_module(self, spec.name, spec.origin, raw_importer(spec.origin))
+            if module:
+                spec.loader_state = module
+                return module
+            return file_loader(spec.name, spec.origin).create_module(spec)
+        
+        def exec_module(self, module):
+            spec = module.__spec__
+            if spec.loader_state is not module:
+                file_loader(spec.name, spec.origin).exec_module(module)
+        
         def find_module(self, fullname, path = None):
-            namepart = joinpath(fullname.replace(".", "/"), basedir = self.import_base_dir)
-            for ext in self.RAW_IMPORTER_MAP:
-                if os.path.isfile(namepart + ext):
-                    namepart += ext
-                    if self.local_hooks:
-                        trying = self.local_hooks.find_module(self, fullname, path, namepart)
-                        if trying:
-                            return trying
-                    else:
-                        return self
+            # Python 2
+            found = self.find(fullname, path)
+            if found:
+                return found[0] or self
         
         def load_module(self, fullname):
-            namepart = joinpath(fullname.replace(".", "/"), basedir = self.import_base_dir)
-            for ext, rawimp in self.RAW_IMPORTER_MAP.items():
-                if os.path.isfile(namepart + ext):
-                    namepart += ext
-                    if self.local_hooks:
-                        trying = self.local_hooks.load_module(self, fullname, namepart, rawimp)
-                        if trying:
-                            return trying
-                    else:
-                        return rawimp(fullname, namepart)
+            # Python 2
+            filepath, is_package = self.index[fullname]
+            rawimp = raw_importer(filepath)
+            if self.local_hooks:
+                trying = self.local_hooks.load_module(self, fullname, filepath, rawimp)
+                if trying:
+                    return trying
+            if is_package:
+                return imp.load_module(fullname, None, os.path.dirname(filepath), ("", "", imp.PKG_DIRECTORY))
+            return rawimp(fullname, filepath)
     
-    unique_list_add(sys.meta_path, BehalfImporter())
+    # next to the builtin and frozen importers, ahead of the path based finders;
+    # the expanded modules are found without scanning sys.path, and take precedence over the modules on it
+    importer = BehalfImporter()
+    if not importer in sys.meta_path:
+        position = 0
+        for i, finder in enumerate(sys.meta_path):
+            if getattr(finder, "__name__", None) in ("BuiltinImporter", "FrozenImporter"):
+                position = i + 1
+        sys.meta_path.insert(position, importer)
     
     return locals()
 
@@ -521,7 +521,7 @@ class ZipOutput(object):
     def __exit__(self, etype, einst, etrace):
         self.close()
     
-    def writefile(self, srcfile, arcname = None):
+    def writefile(self, srcfile, arcname = None, compress_type = None):
         """
         `zipfile.Zipfile.write` のように既存のファイルをこの ZIPへ追加する
         """
@@ -529,7 +529,7 @@ class ZipOutput(object):
             os.path.basename(srcfile)
         if not arcname in self.packed:
             self.packed.add(arcname)
-            self.__out.write(srcfile, arcname)
+            self.__out.write(srcfile, arcname, compress_type)
     
     def writebytes(self, arcname, abytes = b""):
         """
@@ -564,11 +564,15 @@ class WrappedBlobWriter(object):
     """
     :class:`blobstore.BlobWriter` を用いた BLOBファイルへの書き込みをラップしたもの
     """
-    def __init__(self, blobfilename = None):
+    def __init__(self, blobfilename = None, **options):
         """
-        対象のファイル名、または一時ファイルとして初期化する
+        対象のファイル名、または一時ファイルとして初期化する;
+        `options` は :class:`blobstore.BlobWriter` へそのまま渡される
+        (`shard_by` が与えられた場合は :class:`blobstore.ShardedBlobWriter` へ渡される)
         """
-        self.__out = blobstore.BlobWriter(blobfilename or tempfile.NamedTemporaryFile("wb", delete = False).name)
+        writer_class = blobstore.ShardedBlobWriter if options.get("shard_by") else blobstore.BlobWriter
+        self.__out = writer_class(blobfilename or tempfile.NamedTemporaryFile("wb", delete = False).name, **options)
+        self.__volumes = getattr(self.__out, "shard_filenames", [])
         self.__is_tempfile = blobfilename is None
         self.__filename = FilePath.ensure(self.__out.filename)
         self.packed = set()
@@ -594,6 +598,13 @@ class WrappedBlobWriter(object):
         """
         return self.__filename
     
+    @property
+    def volumes(self):
+        """
+        書き込み先のファイルに付随するファイル(シャード)の、(ファイル名の接尾辞, ファイルパス) のリストを得る
+        """
+        return [(FilePath.ensure(vol)[len(self.__filename):], FilePath.ensure(vol)) for vol in self.__volumes]
+    
     def close(self):
         """
         書き込みを完了する
@@ -601,6 +612,8 @@ class WrappedBlobWriter(object):
         if self.is_closed:
             return
         self.__out.close()
+        if self.__out.dedup_count:
+            print("(deduplicated %d entries, saved %d bytes)" % (self.__out.dedup_count, self.__out.dedup_saved))
         self.__out = None
     
     @property
@@ -621,6 +634,8 @@ class WrappedBlobWriter(object):
         if self.is_tempfile:
             print("(remove tempfile %s)" % self.filename)
             os.remove(self.filename)
+            for _, volume in self.volumes:
+                os.remove(volume)
     
     def __enter__(self):
         return self